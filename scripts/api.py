@@ -1,13 +1,43 @@
+import json
+import math
+import time
 import shutil
+import asyncio
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+from typing import Optional
+from datetime import datetime
+from pathlib import PurePosixPath
 from pathlib import Path
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, UploadFile, HTTPException
+from fastapi import FastAPI, UploadFile, HTTPException, Request, File, Body, Query
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
 import aiofiles
+import fitz
 
 from pg_config import get_api_key, get_rm_model_dir, get_server_cache_dir
+from pg_config import get_num_workers, get_health_check_interval, get_queue_mode
+from pg_config import get_poll_interval, get_stale_claim_timeout, get_pipeline_config, get_max_queue_depth
+from pg_config import get_max_attempts, get_auto_retries, get_cache_limits, get_recycle_limits
+from pg_config import get_max_upload_size, get_max_batch_upload_size, get_job_deadline
+from pg_config import get_priority_weights, get_scheduling_policy, get_aging_rate
 from task_manager import TaskManager, create_db_pool, get_job_details_async, remove_job_async
 from task_manager import remove_job_by_paper_id_async, list_jobs_async
+from task_manager import create_job_from_cache_async, invalidate_result_cache_async
+from task_manager import get_job_statuses_async, get_batch_status_async, get_job_status_async
+from task_manager import FINAL_JOB_STATES, get_job_status_details_async, get_queue_stats_async
+from task_manager import cancel_job_async, get_admission_stats_async, post_webhook
+from scheduler import PRIORITY_CLASSES, DEFAULT_PRIORITY
+from job_events import JobEventHub
+from metrics import ExtractionMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from cache_janitor import CacheJanitor
+from pdf_table_extractor_api import get_model_version
+from extract_tables_from_pdf import FITZ_LOCK
 
 # WD = "/tmp/cache"
 WD = get_server_cache_dir()
@@ -16,7 +46,38 @@ Path(WD).mkdir(exist_ok=True)
 # con = connect()
 API_KEY = get_api_key()
 rm_model_dir = get_rm_model_dir()
-task_manager = TaskManager(Path(rm_model_dir))
+task_manager = TaskManager(Path(rm_model_dir), num_workers=get_num_workers(),
+                           health_check_interval=get_health_check_interval(),
+                           queue_mode=get_queue_mode(), poll_interval=get_poll_interval(),
+                           stale_claim_timeout=get_stale_claim_timeout(),
+                           pipeline_config=get_pipeline_config(), job_deadline=get_job_deadline(),
+                           priority_weights=get_priority_weights(), scheduling_policy=get_scheduling_policy(),
+                           aging_rate=get_aging_rate(), max_attempts=get_max_attempts(),
+                           max_retries=get_auto_retries(), recycle_limits=get_recycle_limits())
+# fingerprint of the models, part of the result cache key
+model_version = get_model_version(Path(rm_model_dir))
+MAX_UPLOAD_SIZE = get_max_upload_size()
+MAX_BATCH_UPLOAD_SIZE = get_max_batch_upload_size()
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PDF_MAGIC = b'%PDF-'
+MAX_LONG_POLL_TIMEOUT = 120
+SSE_KEEPALIVE_INTERVAL = 15
+MAX_LIST_JOBS_LIMIT = 1000
+# time window (secs) over which the throughput reported by /pdf_table_extractor/stats is measured
+THROUGHPUT_WINDOW = 600
+MAX_QUEUE_DEPTH = get_max_queue_depth()
+# how long (secs) the queue depth and drain rate used for admission control are reused
+ADMISSION_STATS_TTL = 2
+# Retry-After (secs) bounds of rejected submissions
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 3600
+admission_stats = {'updated': 0, 'waiting': 0, 'drain_rate': 0.0}
+job_event_hub = JobEventHub()
+extraction_metrics = ExtractionMetrics()
+job_event_hub.add_listener(extraction_metrics.observe_job_event)
+cache_max_bytes, cache_ttl, cache_clean_up_interval = get_cache_limits()
+cache_janitor = CacheJanitor(WD, max_bytes=cache_max_bytes, ttl_secs=cache_ttl, interval=cache_clean_up_interval,
+                             on_evict=extraction_metrics.observe_cache_eviction)
 
 
 def save_upload_file(upload_file: UploadFile, destination: Path) -> None:
@@ -27,62 +88,479 @@ def save_upload_file(upload_file: UploadFile, destination: Path) -> None:
         upload_file.close()
 
 
+async def save_upload_file_async(upload_file: UploadFile, destination: Path, max_size: int):
+    """
+    Streams the uploaded file to the destination chunk by chunk, computing its SHA-256 on the fly.
+    :return: SHA-256 hex digest and size of the file
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    async with aiofiles.open(destination, 'wb') as f:
+        while True:
+            chunk = await upload_file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            # PDF readers accept the header anywhere in the first 1024 bytes
+            if size == 0 and PDF_MAGIC not in chunk[:1024]:
+                raise HTTPException(status_code=415, detail="Not a PDF file")
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(status_code=413, detail=f"PDF file is larger than {max_size} bytes")
+            # hashlib releases the GIL for large buffers
+            await run_in_threadpool(sha256.update, chunk)
+            await f.write(chunk)
+    if size == 0:
+        raise HTTPException(status_code=400, detail="Empty file")
+    return sha256.hexdigest(), size
+
+
+def get_pdf_page_count(pdf_path: Path):
+    # cost estimate of the job for shortest job first scheduling, only reads the PDF page tree
+    try:
+        with FITZ_LOCK, fitz.open(pdf_path) as doc:
+            return doc.page_count
+    except Exception as err:
+        print(f"cannot read the page count of {pdf_path}: {err}")
+        return None
+
+
+async def check_admission(num_jobs=1):
+    """
+    Rejects the submission with 429 Too Many Requests if the queue is full. The Retry-After is the time
+    the workers need to drain the excess jobs at the rate measured over the throughput window.
+    """
+    if MAX_QUEUE_DEPTH <= 0:
+        return
+    now = time.time()
+    if now - admission_stats['updated'] > ADMISSION_STATS_TTL:
+        waiting, processed = await get_admission_stats_async(app.state.pool, THROUGHPUT_WINDOW)
+        admission_stats.update(updated=now, waiting=waiting, drain_rate=processed / THROUGHPUT_WINDOW)
+    excess = admission_stats['waiting'] + num_jobs - MAX_QUEUE_DEPTH
+    if excess <= 0:
+        admission_stats['waiting'] += num_jobs
+        return
+    drain_rate = admission_stats['drain_rate']
+    retry_after = math.ceil(excess / drain_rate) if drain_rate > 0 else MAX_RETRY_AFTER
+    retry_after = min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, retry_after))
+    raise HTTPException(status_code=429, detail="Too many jobs waiting, retry later",
+                        headers={'Retry-After': str(retry_after)})
+
+
+def check_priority(priority: str):
+    if priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail="priority must be one of {}".format(", ".join(PRIORITY_CLASSES)))
+
+
+def get_paper_dir(paper_id: str, use_row_info: bool):
+    return Path(WD, paper_id + "_use_row_info") if use_row_info else Path(WD, paper_id)
+
+
+def save_batch_pdf(src, member_name: str, default_parent: Optional[str], use_row_info: bool, max_size: int):
+    """
+    Copies a PDF of a batch from the given file object into its own paper dir. The paper id is built from
+    the name of the PDF's parent dir (or the default parent) and the file name stem.
+    :return: batch entry dict, with an error key if the PDF is rejected
+    """
+    member_path = PurePosixPath(member_name.replace('\\', '/'))
+    parent = member_path.parent.name or default_parent
+    paper_id = "{}_{}".format(parent, member_path.stem) if parent else member_path.stem
+    entry = {'paper_id': paper_id, 'pdf_file': member_path.name}
+    paper_dir = get_paper_dir(paper_id, use_row_info)
+    if paper_dir.is_dir():
+        entry['error'] = "Already exists"
+        return entry
+    paper_dir.mkdir(parents=True)
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(Path(paper_dir, member_path.name), 'wb') as f:
+        while True:
+            chunk = src.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if size == 0 and PDF_MAGIC not in chunk[:1024]:
+                entry['error'] = "Not a PDF file"
+                break
+            size += len(chunk)
+            if size > max_size:
+                entry['error'] = f"PDF file is larger than {max_size} bytes"
+                break
+            sha256.update(chunk)
+            f.write(chunk)
+    if size == 0 and 'error' not in entry:
+        entry['error'] = "Empty file"
+    if 'error' in entry:
+        shutil.rmtree(paper_dir, ignore_errors=True)
+        return entry
+    entry['work_dir'] = paper_dir
+    entry['pdf_hash'] = sha256.hexdigest()
+    entry['page_count'] = get_pdf_page_count(Path(paper_dir, member_path.name))
+    return entry
+
+
+def save_archive_pdfs(archive_path: Path, default_parent: Optional[str], use_row_info: bool):
+    entries = []
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.lower().endswith('.pdf'):
+                    continue
+                with zf.open(info) as src:
+                    entries.append(save_batch_pdf(src, info.filename, default_parent, use_row_info,
+                                                  MAX_UPLOAD_SIZE))
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as tf:
+            for member in tf:
+                if not member.isfile() or not member.name.lower().endswith('.pdf'):
+                    continue
+                src = tf.extractfile(member)
+                entries.append(save_batch_pdf(src, member.name, default_parent, use_row_info, MAX_UPLOAD_SIZE))
+    else:
+        raise HTTPException(status_code=415, detail="Not a zip or tar archive")
+    return entries
+
+
+async def save_archive_upload(archive: UploadFile, default_parent: Optional[str], use_row_info: bool):
+    with tempfile.TemporaryDirectory(dir=WD) as tmp_dir:
+        archive_path = Path(tmp_dir, Path(archive.filename).name or "archive")
+        size = 0
+        async with aiofiles.open(archive_path, 'wb') as f:
+            while True:
+                chunk = await archive.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_BATCH_UPLOAD_SIZE:
+                    raise HTTPException(status_code=413,
+                                        detail=f"Archive is larger than {MAX_BATCH_UPLOAD_SIZE} bytes")
+                await f.write(chunk)
+        return await run_in_threadpool(save_archive_pdfs, archive_path, default_parent, use_row_info)
+
+
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
     _app.state.pool = await create_db_pool()
     print("Created db connection pool.", flush=True)
+    await job_event_hub.start()
+    print("Listening to job status notifications.", flush=True)
     task_manager.start()
+    num_reclaimed, num_enqueued = await run_in_threadpool(task_manager.recover_jobs)
+    print(f"Recovered {num_reclaimed} orphaned running and re-enqueued {num_enqueued} waiting jobs.", flush=True)
+    cache_janitor.start()
     yield
+    cache_janitor.stop()
     print("shutting down task manager...", flush=True)
     task_manager.shutdown()
     print("shut down task manager.", flush=True)
+    await job_event_hub.stop()
     if _app.state.pool:
         await _app.state.pool.close()
         print("shut down connection pool.", flush=True)
     # con.close()
 
 
+class SelectiveGZipMiddleware(object):
+    # gzip responses for clients accepting it, except for event streams which must not be buffered
+    def __init__(self, _app, minimum_size=1024, excluded_paths=()):
+        self.app = _app
+        self.gzip_app = GZipMiddleware(_app, minimum_size=minimum_size)
+        self.excluded_paths = set(excluded_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] in self.excluded_paths:
+            await self.app(scope, receive, send)
+        else:
+            await self.gzip_app(scope, receive, send)
+
+
+class UploadSizeLimitMiddleware(object):
+    # reject oversized request bodies while they are received, before form parsing spools them to disk
+    def __init__(self, _app, limits=None):
+        self.app = _app
+        self.limits = dict(limits or {})
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope['path']) if scope['type'] == 'http' else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        detail = f"Request body is larger than {limit} bytes"
+        headers = dict(scope['headers'])
+        content_length = headers.get(b'content-length', b'').decode('latin-1')
+        if content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse(status_code=413, content={"detail": detail})
+            await response(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024, excluded_paths=["/pdf_table_extractor/job_events"])
+# multipart overhead on top of the file size caps, the exact caps are enforced in save_upload_file_async
+app.add_middleware(UploadSizeLimitMiddleware, limits={
+    "/pdf_table_extractor/submit_paper": MAX_UPLOAD_SIZE + UPLOAD_CHUNK_SIZE,
+    "/pdf_table_extractor/submit_batch": MAX_BATCH_UPLOAD_SIZE + UPLOAD_CHUNK_SIZE,
+})
+
+
+def to_job_results_response(job_detail, headers=None):
+    # the stored results JSON is spliced into the response without being decoded and re-encoded
+    raw_result = job_detail.pop('result')
+    head = json.dumps(jsonable_encoder(job_detail))
+    body = head[:-1] + ', "result": ' + raw_result + '}'
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @app.post("/pdf_table_extractor/submit_paper")
-async def submit_paper(paper_id: str, pdf_file: UploadFile, use_row_info: bool = False):
-    paper_dir = Path(WD, paper_id + "_use_row_info") if use_row_info else Path(WD, paper_id)
+async def submit_paper(paper_id: str, pdf_file: UploadFile, use_row_info: bool = False,
+                       webhook_url: Optional[str] = None, priority: str = DEFAULT_PRIORITY):
+    check_priority(priority)
+    await check_admission()
+    paper_dir = get_paper_dir(paper_id, use_row_info)
     if paper_dir.is_dir():
         raise HTTPException(status_code=400, detail="Already exists")
         # shutil.rmtree(paper_dir)
 
     paper_dir.mkdir(parents=True, exist_ok=True)
-    dest = Path(paper_dir, pdf_file.filename)
-    async with aiofiles.open(dest, 'wb') as f:
-        content = await pdf_file.read()
-        await f.write(content)
+    pdf_filename = Path(pdf_file.filename).name
+    dest = Path(paper_dir, pdf_filename)
+    try:
+        pdf_hash, _ = await save_upload_file_async(pdf_file, dest, MAX_UPLOAD_SIZE)
+    except HTTPException:
+        await run_in_threadpool(shutil.rmtree, paper_dir, ignore_errors=True)
+        raise
+    finally:
+        await pdf_file.close()
     # _job_id = task_manager.add_job(con, paper_id, pdf_file.filename, paper_dir, use_row_info=use_row_info)
     pool = app.state.pool
-    _job_id = await task_manager.add_job_async(pool, paper_id, pdf_file.filename, paper_dir,
-                                               use_row_info=use_row_info)
-    return {"filename": pdf_file.filename, "paper_id": paper_id, "job_id": _job_id}
+    _job_id = await create_job_from_cache_async(pool, paper_id, pdf_filename, use_row_info, paper_dir,
+                                                pdf_hash, model_version)
+    if _job_id is not None:
+        post_webhook({'job_id': _job_id, 'paper_id': paper_id, 'webhook_url': webhook_url}, 'finished')
+        return {"filename": pdf_filename, "paper_id": paper_id, "job_id": _job_id, "cached": True}
+    page_count = await run_in_threadpool(get_pdf_page_count, dest)
+    _job_id = await task_manager.add_job_async(pool, paper_id, pdf_filename, paper_dir,
+                                               use_row_info=use_row_info, pdf_hash=pdf_hash,
+                                               model_version=model_version, webhook_url=webhook_url,
+                                               priority=priority, page_count=page_count)
+    return {"filename": pdf_filename, "paper_id": paper_id, "job_id": _job_id, "cached": False}
+
+
+@app.post("/pdf_table_extractor/submit_batch")
+async def submit_batch(paper_id: Optional[str] = None, use_row_info: bool = False,
+                       pdf_files: Optional[list[UploadFile]] = File(None),
+                       archive: Optional[UploadFile] = File(None), webhook_url: Optional[str] = None,
+                       priority: str = DEFAULT_PRIORITY):
+    # accepts either many PDFs or a zip/tar archive of a paper directory (tree).
+    # the paper id of each PDF is <parent-dir-name or paper_id>_<pdf-file-stem>
+    check_priority(priority)
+    entries = []
+    try:
+        if archive is not None:
+            entries.extend(await save_archive_upload(archive, paper_id, use_row_info))
+        for pdf_file in pdf_files or []:
+            entries.append(await run_in_threadpool(save_batch_pdf, pdf_file.file, pdf_file.filename, paper_id,
+                                                   use_row_info, MAX_UPLOAD_SIZE))
+    finally:
+        if archive is not None:
+            await archive.close()
+        for pdf_file in pdf_files or []:
+            await pdf_file.close()
+    accepted = [e for e in entries if 'error' not in e]
+    rejected = [{'paper_id': e['paper_id'], 'filename': e['pdf_file'], 'error': e['error']}
+                for e in entries if 'error' in e]
+    if not accepted:
+        raise HTTPException(status_code=400, detail={"message": "No PDF files to process", "rejected": rejected})
+    # the number of jobs of an archive is only known after extracting it
+    try:
+        await check_admission(len(accepted))
+    except HTTPException:
+        for e in accepted:
+            await run_in_threadpool(shutil.rmtree, e['work_dir'], ignore_errors=True)
+        raise
+    pool = app.state.pool
+    batch_id, accepted = await task_manager.add_jobs_async(pool, accepted, use_row_info=use_row_info,
+                                                           model_version=model_version, webhook_url=webhook_url,
+                                                           priority=priority)
+    for e in accepted:
+        if e['job_status'] == 'finished':
+            post_webhook({'job_id': e['job_id'], 'paper_id': e['paper_id'], 'webhook_url': webhook_url}, 'finished')
+    jobs = [{'filename': e['pdf_file'], 'paper_id': e['paper_id'], 'job_id': e['job_id'],
+             'cached': e['job_status'] == 'finished'} for e in accepted]
+    return {"batch_id": batch_id, "jobs": jobs, "rejected": rejected}
+
+
+@app.post("/pdf_table_extractor/job_statuses")
+async def get_job_statuses(job_ids: list[int] = Body(...)):
+    pool = app.state.pool
+    return jsonable_encoder(await get_job_statuses_async(pool, job_ids))
+
+
+@app.get("/pdf_table_extractor/batch_status")
+async def get_batch_status(batch_id: int):
+    pool = app.state.pool
+    statuses = await get_batch_status_async(pool, batch_id)
+    if not statuses:
+        raise HTTPException(status_code=404, detail=f"Batch with ID {batch_id} Not found")
+    return jsonable_encoder({"batch_id": batch_id, "jobs": statuses})
 
 
 @app.get("/pdf_table_extractor/list_jobs")
-async def list_jobs(api_key: str):
+async def list_jobs(api_key: str, after_job_id: Optional[int] = None,
+                    limit: int = Query(default=100, ge=1, le=MAX_LIST_JOBS_LIMIT),
+                    job_status: Optional[str] = None, paper_id_prefix: Optional[str] = None,
+                    since: Optional[datetime] = None, until: Optional[datetime] = None,
+                    use_row_info: Optional[bool] = None):
     if api_key != API_KEY:
         raise HTTPException(status_code=403, detail="You are not authorized to list jobs!")
     pool = app.state.pool
-    ji_list = await list_jobs_async(pool)
-    return jsonable_encoder(ji_list)
+    since, until = to_local_naive(since), to_local_naive(until)
+    ji_list, next_after_job_id = await list_jobs_async(pool, after_job_id=after_job_id, limit=limit,
+                                                       job_status=job_status, paper_id_prefix=paper_id_prefix,
+                                                       since=since, until=until, use_row_info=use_row_info)
+    return jsonable_encoder({"jobs": ji_list, "next_after_job_id": next_after_job_id})
+
+
+def to_local_naive(dt: Optional[datetime]):
+    """The job timestamps are stored as naive local time, ISO 8601 values with an offset are converted."""
+    if dt is None or dt.tzinfo is None:
+        return dt
+    return dt.astimezone().replace(tzinfo=None)
+
+
+def get_job_etag(job_status_detail):
+    last_modified = job_status_detail['last_modified']
+    ts = last_modified.timestamp() if last_modified else 0
+    return '"{}-{}-{}"'.format(job_status_detail['job_id'], job_status_detail['job_status'], ts)
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return etag in tags or 'W/' + etag in tags
+
+
+@app.get("/pdf_table_extractor/get_job_status")
+async def get_job_status(job_id: int):
+    # job status without the results
+    pool = app.state.pool
+    job_status_detail = await get_job_status_details_async(pool, job_id)
+    if not job_status_detail:
+        raise HTTPException(status_code=404, detail=f"Job with ID {job_id} Not found")
+    return jsonable_encoder(job_status_detail)
 
 
 @app.get("/pdf_table_extractor/get_job_results")
-async def get_job_results(job_id: str):
+async def get_job_results(job_id: str, request: Request):
     # get job results and/or job status
     # job_detail = task_manager.get_job_detail(con, job_id)
     pool = app.state.pool
-    job_detail = await get_job_details_async(pool, int(job_id))
+    # cheap lookup first, unchanged jobs are answered with an empty 304
+    job_status_detail = await get_job_status_details_async(pool, int(job_id))
+    if not job_status_detail:
+        raise HTTPException(status_code=404, detail=f"Job with ID {job_id} Not found")
+    etag = get_job_etag(job_status_detail)
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    job_detail = await get_job_details_async(pool, int(job_id), raw=True)
+
+    if not job_detail:
+        raise HTTPException(status_code=404, detail=f"Job with ID {job_id} Not found")
+    return to_job_results_response(job_detail, headers={'ETag': etag})
 
+
+@app.get("/pdf_table_extractor/wait_job_results")
+async def wait_job_results(job_id: int, timeout: float = 30, last_status: Optional[str] = None):
+    # long-poll variant of get_job_results. Blocks until the job status differs from last_status
+    # (or, without last_status, until the job is finished or failed) or the timeout passes
+    timeout = min(max(timeout, 0), MAX_LONG_POLL_TIMEOUT)
+    pool = app.state.pool
+    # subscribe before checking the status so that no transition is missed
+    subscription = job_event_hub.subscribe([job_id])
+    try:
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            job_status = await get_job_status_async(pool, job_id)
+            if job_status is None:
+                raise HTTPException(status_code=404, detail=f"Job with ID {job_id} Not found")
+            if (last_status and job_status != last_status) or (not last_status and job_status in FINAL_JOB_STATES):
+                break
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            await subscription.next_event(remaining)
+    finally:
+        job_event_hub.unsubscribe(subscription)
+    job_detail = await get_job_details_async(pool, job_id, raw=True)
     if not job_detail:
-        raise HTTPException(status_code=404, detail="Job with ID %s Not found".format(job_id))
-    return jsonable_encoder(job_detail)
+        raise HTTPException(status_code=404, detail=f"Job with ID {job_id} Not found")
+    return to_job_results_response(job_detail)
+
+
+@app.get("/pdf_table_extractor/job_events")
+async def job_events(request: Request, job_ids: Optional[list[int]] = Query(None)):
+    # server-sent events stream of job state transitions (of the given jobs or of all jobs)
+    pool = app.state.pool
+    subscription = job_event_hub.subscribe(job_ids)
+
+    async def event_stream():
+        try:
+            if job_ids:
+                # current state first, transitions before the subscription are not replayed
+                for js in await get_job_statuses_async(pool, job_ids):
+                    yield "event: job_status\ndata: {}\n\n".format(json.dumps(js))
+            while not await request.is_disconnected():
+                event = await subscription.next_event(SSE_KEEPALIVE_INTERVAL)
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "event: job_status\ndata: {}\n\n".format(json.dumps(event))
+        finally:
+            job_event_hub.unsubscribe(subscription)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/pdf_table_extractor/cancel_job")
+async def cancel_job(job_id: int, api_key: str):
+    if api_key != API_KEY:
+        raise HTTPException(status_code=403, detail="You are not authorized to cancel a job!")
+    # a running job is stopped by its worker within a heartbeat interval
+    pool = app.state.pool
+    job_status = await cancel_job_async(pool, job_id)
+    if job_status is None:
+        raise HTTPException(status_code=404, detail=f"Job with ID {job_id} Not found")
+    return jsonable_encoder({"job_id": job_id, "job_status": job_status,
+                             "cancel_requested": job_status == 'running'})
+
+
+@app.post("/pdf_table_extractor/retry_job")
+async def retry_job(job_id: int, api_key: str):
+    if api_key != API_KEY:
+        raise HTTPException(status_code=403, detail="You are not authorized to retry a job!")
+    # resumes a failed, timed out or cancelled job after the stages it completed before
+    pool = app.state.pool
+    job = await task_manager.retry_job_async(pool, job_id)
+    if job is None:
+        job_status = await get_job_status_async(pool, job_id)
+        if job_status is None:
+            raise HTTPException(status_code=404, detail=f"Job with ID {job_id} Not found")
+        raise HTTPException(status_code=409, detail=f"Job with ID {job_id} is {job_status}")
+    return jsonable_encoder({"job_id": job_id, "job_status": "waiting"})
 
 
 @app.delete("/pdf_table_extractor/remove_job")
@@ -101,3 +579,47 @@ async def remove_job(paper_id: str, api_key: str):
     pool = app.state.pool
     ok = await remove_job_by_paper_id_async(pool, paper_id)
     return jsonable_encoder({"paper_id": paper_id, "removed": ok})
+
+
+@app.get("/pdf_table_extractor/stats")
+async def get_stats():
+    # queue and worker utilization, e.g. as scale out signal for the workers
+    pool = app.state.pool
+    stats = await get_queue_stats_async(pool, THROUGHPUT_WINDOW)
+    queue_depth = stats['jobs_per_state'].get('waiting', 0)
+    in_progress = queue_depth + stats['jobs_per_state'].get('running', 0)
+    papers_per_min = stats['processed_in_window'] * 60.0 / THROUGHPUT_WINDOW
+    if in_progress == 0:
+        drain_time = 0
+    elif papers_per_min > 0:
+        drain_time = in_progress / papers_per_min * 60.0
+    else:
+        drain_time = None
+    return jsonable_encoder({'queue_depth': queue_depth,
+                             'local_queue_size': task_manager.get_queue_size(),
+                             'jobs_per_state': stats['jobs_per_state'],
+                             'waiting_per_priority': stats['waiting_per_priority'],
+                             'workers': task_manager.get_workers_info(),
+                             'running_jobs': stats['running_jobs'],
+                             'throughput_papers_per_min': papers_per_min,
+                             'throughput_window_secs': THROUGHPUT_WINDOW,
+                             'estimated_drain_secs': drain_time})
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus scrape endpoint
+    return Response(content=extraction_metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+@app.delete("/pdf_table_extractor/invalidate_cache")
+async def invalidate_cache(api_key: str, invalidate_all: bool = False):
+    # to be called after a model in models/ or the row merge model dir is replaced.
+    # removes the cached results of the replaced models (or all cached results if invalidate_all is true)
+    global model_version
+    if api_key != API_KEY:
+        raise HTTPException(status_code=403, detail="You are not authorized to invalidate the cache!")
+    model_version = get_model_version(Path(rm_model_dir))
+    pool = app.state.pool
+    num_removed = await invalidate_result_cache_async(pool, None if invalidate_all else model_version)
+    return jsonable_encoder({"model_version": model_version, "removed": num_removed})
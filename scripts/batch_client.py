@@ -9,6 +9,10 @@ from pathlib import Path
 
 BASE_URL = "http://localhost:8001"
 HOME = os.path.expanduser("~")
+# max number of resubmissions of a PDF rejected because the server queue is full
+MAX_SUBMIT_RETRIES = 20
+# job states after which a job does not change anymore
+FINAL_JOB_STATES = ('finished', 'error', 'cancelled', 'timeout')
 
 
 def save_json(_data, _out_json_file):
@@ -17,11 +21,17 @@ def save_json(_data, _out_json_file):
         print(f"wrote {_out_json_file}.")
 
 
-def submit_paper(_paper_id: str, _pdf_file_path, _use_row_info=False):
+def submit_paper(_paper_id: str, _pdf_file_path, _use_row_info=False, _priority='bulk'):
     url = BASE_URL + '/pdf_table_extractor/submit_paper'
-    files = {'pdf_file': open(_pdf_file_path, 'rb')}
-    params = {'paper_id': _paper_id, 'use_row_info': _use_row_info}
-    response = requests.post(url, files=files, params=params)
+    params = {'paper_id': _paper_id, 'use_row_info': _use_row_info, 'priority': _priority}
+    for _ in range(MAX_SUBMIT_RETRIES):
+        with open(_pdf_file_path, 'rb') as f:
+            response = requests.post(url, files={'pdf_file': f}, params=params)
+        if response.status_code != requests.codes.too_many_requests:
+            break
+        retry_after = int(response.headers.get('Retry-After', '60'))
+        print(f"server queue is full, retrying in {retry_after} secs.")
+        time.sleep(retry_after)
     if response.status_code == requests.codes.ok:
         print(response.json())
         return response.json()
@@ -36,6 +46,38 @@ def submit_a_pdf(_paper_id, _pdf_file, use_row_info=False):
     return result
 
 
+def submit_batch(_pdf_file_paths, _paper_id=None, _use_row_info=False, _archive_path=None, _priority='bulk'):
+    url = BASE_URL + '/pdf_table_extractor/submit_batch'
+    # the server builds the paper id from the parent dir name and the file stem, so PDFs with the same
+    # name in different paper dirs (e.g. media-1.pdf) get their own paper ids
+    files = [('pdf_files', (Path(p).name if _paper_id else "{}/{}".format(Path(p).parent.name, Path(p).name),
+                            open(p, 'rb'), 'application/pdf')) for p in _pdf_file_paths]
+    if _archive_path:
+        files.append(('archive', (Path(_archive_path).name, open(_archive_path, 'rb'))))
+    params = {'use_row_info': _use_row_info, 'priority': _priority}
+    if _paper_id:
+        params['paper_id'] = _paper_id
+    try:
+        response = requests.post(url, files=files, params=params)
+    finally:
+        for _, (_, f, *_) in files:
+            f.close()
+    if response.status_code == requests.codes.ok:
+        print(response.json())
+        return response.json()
+    else:
+        response.raise_for_status()
+
+
+def get_job_statuses(job_ids):
+    url = BASE_URL + "/pdf_table_extractor/job_statuses"
+    response = requests.post(url, json=list(job_ids))
+    if response.status_code == requests.codes.ok:
+        return response.json()
+    else:
+        response.raise_for_status()
+
+
 def get_job_results(job_id):
     url = BASE_URL + "/pdf_table_extractor/get_job_results"
     params = {'job_id': job_id}
@@ -47,6 +89,19 @@ def get_job_results(job_id):
         response.raise_for_status()
 
 
+def wait_job_results(job_id, timeout=30, last_status=None):
+    # long-poll: returns as soon as the job is finished/failed (or its status differs from last_status)
+    url = BASE_URL + "/pdf_table_extractor/wait_job_results"
+    params = {'job_id': job_id, 'timeout': timeout}
+    if last_status:
+        params['last_status'] = last_status
+    response = requests.get(url, params=params, timeout=timeout + 30)
+    if response.status_code == requests.codes.ok:
+        return response.json()
+    else:
+        response.raise_for_status()
+
+
 def test_get_job_results(_job_id, _out_json_file=None):
     job_result = get_job_results(_job_id)
     if job_result:
@@ -56,7 +111,7 @@ def test_get_job_results(_job_id, _out_json_file=None):
         return job_result
         
         
-def handle_paper(pdf_file: Path, out_dir: Path, use_row_info=False):
+def handle_paper(pdf_file: Path, out_dir: Path, use_row_info=False, max_wait=600):
     prefix = pdf_file.stem
     parent_name = pdf_file.parent.name
     paper_id = "{}_{}".format(parent_name, prefix)
@@ -64,18 +119,16 @@ def handle_paper(pdf_file: Path, out_dir: Path, use_row_info=False):
     print(res)
     _job_id = int(res['job_id'])
 
-    total_time = 0
+    start_time = time.time()
     while True:
-        time.sleep(2)
-        total_time += 2
-        result = test_get_job_results(_job_id)
+        result = wait_job_results(_job_id, timeout=30)
         if result and result['job_status'] == 'finished':
             res = result['result']
             if len(res) > 0:
                 out_file = out_dir / "{}_{}_tables.json".format(parent_name, prefix)
-                test_get_job_results(_job_id, out_file)
+                save_json(result, out_file)
             break
-        if (result and result['job_status'] == "error") or total_time >= 30:
+        if (result and result['job_status'] in FINAL_JOB_STATES) or time.time() - start_time >= max_wait:
             break
 
 
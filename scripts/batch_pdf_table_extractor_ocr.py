@@ -37,8 +37,8 @@ class PDFTableExtractor(object):
         pdf_file_stem = Path(_pdf_file_path).stem
         im_out_dir = os.path.join(_out_dir, pdf_file_stem)
         Path(im_out_dir).mkdir(parents=True, exist_ok=True)
-        image_files = pdf_to_images(_pdf_file_path, im_out_dir)
         page_ids = {p['page'] for p in pages}
+        image_files = pdf_to_images(_pdf_file_path, im_out_dir, page_ids=page_ids)
         all_tables = {}
         for image_file in image_files:
             page_num = re.search(r"-(\d+)\.jpg", image_file).group(1)
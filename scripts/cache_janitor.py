@@ -0,0 +1,106 @@
+import os
+import time
+import shutil
+import threading
+import traceback
+from pathlib import Path
+
+import psycopg
+
+from task_manager import connect, get_active_work_dirs
+
+# work dirs modified more recently than this (secs) are never evicted, e.g. a paper dir being uploaded
+# to before its job row exists or a temporary dir of a batch upload
+MIN_EVICTION_AGE = 3600
+
+
+def get_dir_usage(dir_path):
+    """:return: total size in bytes and the last access or modification time of the files in the dir tree"""
+    total = 0
+    last_access = os.stat(dir_path).st_mtime
+    for root, _, files in os.walk(dir_path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            total += st.st_size
+            last_access = max(last_access, st.st_atime, st.st_mtime)
+    return total, last_access
+
+
+class CacheJanitor(object):
+    """
+    Background thread bounding the disk usage of the server cache dir. Paper work dirs not accessed
+    for longer than the TTL are removed, then the least recently accessed ones until the cache is
+    below the byte cap. Work dirs of waiting and running jobs are never removed.
+    """
+    def __init__(self, cache_dir, max_bytes=None, ttl_secs=None, interval=600, on_evict=None):
+        """
+        :param on_evict: called with the number of removed dirs and reclaimed bytes and the remaining
+                         cache size after each run
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        self.interval = interval
+        self.on_evict = on_evict
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="cache_janitor")
+
+    def start(self):
+        if self.max_bytes or self.ttl_secs:
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.clean_up()
+            except (Exception, psycopg.Error) as error:
+                print("cache janitor error", error)
+                print(traceback.format_exc())
+
+    def clean_up(self):
+        """:return: number of removed dirs and reclaimed bytes"""
+        _con = None
+        try:
+            _con = connect()
+            active_dirs = {os.path.realpath(wd) for wd in get_active_work_dirs(_con)}
+        finally:
+            if _con:
+                _con.close()
+        now = time.time()
+        candidates = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            size, last_access = get_dir_usage(entry.path)
+            total += size
+            if os.path.realpath(entry.path) in active_dirs or entry.name.startswith('tmp'):
+                continue
+            if now - last_access < MIN_EVICTION_AGE:
+                continue
+            candidates.append((last_access, size, entry.path))
+        # least recently accessed first
+        candidates.sort()
+        num_removed = 0
+        reclaimed = 0
+        for last_access, size, path in candidates:
+            expired = self.ttl_secs and now - last_access > self.ttl_secs
+            over_cap = self.max_bytes and total - reclaimed > self.max_bytes
+            if not expired and not over_cap:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            num_removed += 1
+            reclaimed += size
+        if num_removed:
+            print(f"cache janitor: removed {num_removed} work dirs, reclaimed {reclaimed} bytes", flush=True)
+        if self.on_evict:
+            self.on_evict(num_removed, reclaimed, total - reclaimed)
+        return num_removed, reclaimed
@@ -0,0 +1,95 @@
+-- Table Detection and Extraction Server schema
+-- psql -U czi -d czi_pdf_table_extractor < db_schema.sql
+-- The script is idempotent and can be re-run to upgrade an existing database.
+
+create table if not exists job_detail (
+    job_detail_id serial primary key,
+    paper_id      text not null,
+    pdf_file      text,
+    err_msg       text,
+    params        text,
+    last_modified timestamp,
+    tables_data   text
+);
+
+create table if not exists jobs (
+    job_id        serial primary key,
+    job_status    varchar(20) not null,
+    start_time    timestamp,
+    job_detail_id integer references job_detail (job_detail_id)
+);
+
+-- durable (db) queue mode
+alter table job_detail add column if not exists work_dir text;
+alter table jobs add column if not exists claimed_by text;
+alter table jobs add column if not exists claim_time timestamp;
+alter table jobs add column if not exists heartbeat timestamp;
+alter table jobs add column if not exists attempts integer not null default 0;
+
+create index if not exists jobs_waiting_idx on jobs (job_id) where job_status = 'waiting';
+create index if not exists jobs_running_heartbeat_idx on jobs (heartbeat) where job_status = 'running';
+
+-- content addressed result cache
+alter table job_detail add column if not exists pdf_hash text;
+alter table job_detail add column if not exists model_version text;
+
+create table if not exists result_cache (
+    pdf_hash      text    not null,
+    use_row_info  boolean not null,
+    model_version text    not null,
+    tables_data   text,
+    created       timestamp,
+    primary key (pdf_hash, use_row_info, model_version)
+);
+
+-- batch submission
+create table if not exists batches (
+    batch_id serial primary key,
+    created  timestamp,
+    num_jobs integer
+);
+
+alter table jobs add column if not exists batch_id integer references batches (batch_id);
+create index if not exists jobs_batch_id_idx on jobs (batch_id) where batch_id is not null;
+
+-- push based job completion
+alter table job_detail add column if not exists webhook_url text;
+
+-- results are stored as jsonb
+do $$
+begin
+    if (select data_type from information_schema.columns
+        where table_name = 'job_detail' and column_name = 'tables_data') = 'text' then
+        alter table job_detail alter column tables_data type jsonb using tables_data::jsonb;
+    end if;
+    if (select data_type from information_schema.columns
+        where table_name = 'result_cache' and column_name = 'tables_data') = 'text' then
+        alter table result_cache alter column tables_data type jsonb using tables_data::jsonb;
+    end if;
+end $$;
+
+-- job listing (keyset pagination by job_id with filters) and removal by paper id
+create index if not exists jobs_status_job_id_idx on jobs (job_status, job_id);
+create index if not exists jobs_start_time_idx on jobs (start_time);
+create index if not exists jobs_job_detail_id_idx on jobs (job_detail_id);
+create index if not exists job_detail_paper_id_idx on job_detail (paper_id text_pattern_ops);
+
+-- per stage timings and work counters of the extraction
+alter table job_detail add column if not exists timings jsonb;
+
+-- throughput of the workers (see get_queue_stats_async)
+create index if not exists job_detail_last_modified_idx on job_detail (last_modified);
+
+-- job cancellation and deadlines
+alter table jobs add column if not exists cancel_requested boolean not null default false;
+alter table job_detail add column if not exists stage text;
+
+-- job priority classes (interactive, normal, bulk)
+alter table jobs add column if not exists priority text not null default 'normal';
+create index if not exists jobs_waiting_priority_idx on jobs (priority, job_id) where job_status = 'waiting';
+
+-- shortest job first scheduling by the page count estimated at upload time
+alter table job_detail add column if not exists page_count integer;
+alter table jobs add column if not exists cost_key double precision;
+create index if not exists jobs_waiting_cost_idx on jobs (priority, cost_key nulls first, job_id)
+    where job_status = 'waiting';
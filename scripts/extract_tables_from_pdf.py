@@ -4,8 +4,10 @@ import re
 import json
 from datetime import datetime
 import shutil
+import threading
 import subprocess
 from pathlib import Path
+import fitz
 import torch
 import PIL
 from PIL import Image
@@ -13,17 +15,63 @@ from os.path import expanduser
 from transformers import DetrFeatureExtractor
 from transformers import TableTransformerForObjectDetection
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from table_model import build_table, extract_table_text, extract_table_region_text
+from job_control import run_subprocess, get_current, set_current, check_current
 
 
 TableImage = namedtuple('TableImage', ['image', 'left', 'top', 'right', 'bottom'])
 PIL.Image.MAX_IMAGE_PIXELS = 933120000
+# margin (pixels at RENDER_DPI) added around the detected table regions
+TABLE_MARGIN = 25
+# max number of pdftoppm processes rendering the page ranges of a PDF in parallel
+RASTERIZE_WORKERS = 4
+# resolution of the page images (the pdftoppm default)
+RENDER_DPI = 150
+# number of page images per table detection forward pass
+DETECT_BATCH_SIZE = 8
+# number of table images per table structure recognition forward pass
+STRUCTURE_BATCH_SIZE = 8
+# PyMuPDF is not thread safe, all fitz use in the process goes through this lock
+FITZ_LOCK = threading.Lock()
 
 
-def extract_table_images(pil_img, boxes, offset=25):
+def save_table_structure(_table, table_image, page_num, table_no, out_dir, prefix, save_images=True):
+    """
+    Writes the table structure JSON (and the table image if save_images) of the table_no'th table
+    of the page to the work dir.
+    """
+    im_filename = "{}_page_{}_table_{}.jpg".format(prefix, page_num, table_no)
+    filename = "{}_page_{}_table_{}.json".format(prefix, page_num, table_no)
+    struct_dir = Path(out_dir, 'structure')
+    struct_dir.mkdir(parents=True, exist_ok=True)
+    fpath = Path(struct_dir, filename)
+    with open(fpath, 'w') as f:
+        json.dump(_table.to_json(), f, indent=2)
+        print(f"wrote {fpath}")
+    if save_images:
+        # save table image for debugging
+        im_dir = Path(out_dir, "table_images")
+        im_dir.mkdir(parents=True, exist_ok=True)
+        im_fpath = Path(im_dir, im_filename)
+        table_image.image.save(im_fpath)
+        print(f'saved {im_fpath}')
+
+
+def load_page_image(page_image):
+    """
+    :param page_image: page image file or PIL image
+    :return: RGB PIL image
+    """
+    if isinstance(page_image, Image.Image):
+        return page_image.convert("RGB")
+    return Image.open(page_image).convert("RGB")
+
+
+def extract_table_images(pil_img, boxes, offset=TABLE_MARGIN):
     table_images = []
-    for (xmin, ymin, xmax, ymax) in boxes.tolist():
+    for (xmin, ymin, xmax, ymax) in boxes:
         print("xmin:{} ymin:{} xmax:{} ymax:{}".format(xmin, ymin, xmax, ymax))
         table_im = pil_img.crop((xmin - offset, ymin - offset, xmax + offset, ymax + offset))
         table_images.append(TableImage(image=table_im, left=xmin - offset, top=ymin - offset,
@@ -41,6 +89,8 @@ class TableExtractor(object):
             "microsoft/table-transformer-structure-recognition")
         self.td_model.to(self.device)
         self.tsr_model.to(self.device)
+        # the image processor (resizing, normalization, padding) is shared by both models
+        self.fex = DetrFeatureExtractor()
 
     def extract_tables(self, page_jpg_file, out_dir=None, prefix=None, save_cell_images=False):
         result = self.detect_table_regions(page_jpg_file)
@@ -61,34 +111,54 @@ class TableExtractor(object):
                                                  pw=page_width, ph=page_height)
         return None
 
-    def detect_table_regions(self, page_jpg_file):
-        image = Image.open(page_jpg_file).convert("RGB")
-        width, height = image.size
-        image.resize((int(width * 0.5), int(height * 0.5)))
-        fex = DetrFeatureExtractor()
-        encoding = fex(image, return_tensors="pt")
-        encoding.to(self.device)
-        with torch.no_grad():
-            outputs = self.td_model(**encoding)
-        results = fex.post_process_object_detection(outputs, threshold=0.7,
-                                                    target_sizes=[(height, width)])[0]
-        print(f'page height: {height} width: {width}')
-        if results and len(results['boxes']) > 0:
-            table_images = extract_table_images(image, results['boxes'])
-            return table_images, width, height
+    def detect_table_regions(self, page_image):
+        """
+        :param page_image: page image file or PIL image
+        :return: the table images cropped from the page image with the page width and height or None
+        """
+        image = load_page_image(page_image)
+        boxes = self.detect_table_boxes(image)
+        if boxes:
+            width, height = image.size
+            return extract_table_images(image, boxes), width, height
         return None
 
+    def detect_table_boxes(self, image):
+        """
+        :param image: RGB PIL page image
+        :return: (xmin, ymin, xmax, ymax) boxes of the tables detected in the page image (pixels)
+        """
+        return self.detect_table_boxes_batch([image])[0]
+
+    def detect_table_boxes_batch(self, page_images, batch_size=DETECT_BATCH_SIZE):
+        """
+        Runs the table detection on page images, of one or more documents, in padded mini batches.
+        :param page_images: page image files or PIL images
+        :return: per page image the (xmin, ymin, xmax, ymax) boxes of the detected tables (pixels)
+        """
+        all_boxes = []
+        for i in range(0, len(page_images), batch_size):
+            check_current()
+            images = [load_page_image(im) for im in page_images[i:i + batch_size]]
+            encoding = self.fex(images, return_tensors="pt")
+            encoding.to(self.device)
+            with torch.no_grad():
+                outputs = self.td_model(**encoding)
+            target_sizes = [(im.height, im.width) for im in images]
+            results = self.fex.post_process_object_detection(outputs, threshold=0.7, target_sizes=target_sizes)
+            for result in results:
+                all_boxes.append(result['boxes'].tolist())
+            print(f"detected tables on {len(images)} pages", flush=True)
+        return all_boxes
+
     def extract_table_content(self, table_image, save_cell_images=False, out_dir=None):
-        width, height = table_image.image.size
-        table_image.image.resize((int(width * 0.5), int(height * 0.5)))
-        fex = DetrFeatureExtractor()
-        table_encoding = fex(table_image.image, return_tensors="pt")
+        table_encoding = self.fex(table_image.image, return_tensors="pt")
         table_encoding.to(self.device)
         with torch.no_grad():
             outputs = self.tsr_model(**table_encoding)
         target_sizes = [table_image.image.size[::-1]]
-        results = fex.post_process_object_detection(outputs, threshold=0.6,
-                                                    target_sizes=target_sizes)[0]
+        results = self.fex.post_process_object_detection(outputs, threshold=0.6,
+                                                         target_sizes=target_sizes)[0]
         _table = build_table(results['boxes'], results['labels'], table_image)
         start_time = datetime.now()
         if save_cell_images:
@@ -100,18 +170,33 @@ class TableExtractor(object):
         return _table
 
     def extract_table_structure(self, table_image):
-        width, height = table_image.image.size
-        table_image.image.resize((int(width * 0.5), int(height * 0.5)))
-        fex = DetrFeatureExtractor()
-        table_encoding = fex(table_image.image, return_tensors="pt")
-        table_encoding.to(self.device)
-        with torch.no_grad():
-            outputs = self.tsr_model(**table_encoding)
-        target_sizes = [table_image.image.size[::-1]]
-        results = fex.post_process_object_detection(outputs, threshold=0.6,
-                                                    target_sizes=target_sizes)[0]
-        _table = build_table(results['boxes'], results['labels'], table_image)
-        return _table
+        return self.extract_table_structures_batch([table_image])[0]
+
+    def extract_table_structures_batch(self, table_images, batch_size=STRUCTURE_BATCH_SIZE):
+        """
+        Runs the table structure recognition on table images, e.g. of all pages of a document, in
+        padded mini batches. As the image processor scales the images to the same shortest edge, the
+        table images are batched by aspect ratio to keep the padding small.
+        :param table_images: list of TableImage
+        :return: a Table per table image, in the order of the table images
+        """
+        _tables = [None] * len(table_images)
+        order = sorted(range(len(table_images)),
+                       key=lambda j: table_images[j].image.width / max(1, table_images[j].image.height))
+        for i in range(0, len(order), batch_size):
+            check_current()
+            batch = order[i:i + batch_size]
+            images = [table_images[j].image.convert("RGB") for j in batch]
+            table_encoding = self.fex(images, return_tensors="pt")
+            table_encoding.to(self.device)
+            with torch.no_grad():
+                outputs = self.tsr_model(**table_encoding)
+            target_sizes = [(im.height, im.width) for im in images]
+            results = self.fex.post_process_object_detection(outputs, threshold=0.6, target_sizes=target_sizes)
+            for j, result in zip(batch, results):
+                _tables[j] = build_table(result['boxes'], result['labels'], table_images[j])
+            print(f"recognized the structure of {len(images)} tables", flush=True)
+        return _tables
 
     def extract_table_contents(self, table_images, page_num=None, out_dir=None, prefix=None,
                                pw=None, ph=None, save_cell_images=False):
@@ -152,29 +237,14 @@ class TableExtractor(object):
             _tables.append(_table)
         return _tables
 
-    def extract_table_structures(self, table_images, page_num=None, out_dir=None, prefix=None, pw=None, ph=None):
-        _tables = []
-        for i, table_image in enumerate(table_images):
-            _table = self.extract_table_structure(table_image)
+    def extract_table_structures(self, table_images, page_num=None, out_dir=None, prefix=None, pw=None, ph=None,
+                                 save_images=True):
+        _tables = self.extract_table_structures_batch(table_images)
+        for i, (table_image, _table) in enumerate(zip(table_images, _tables)):
             if pw and ph:
                 _table.set_page_info(pw, ph)
             if out_dir:
-                im_filename = "{}_page_{}_table_{}.jpg".format(prefix, page_num, (i + 1))
-                filename = "{}_page_{}_table_{}.json".format(prefix, page_num, (i + 1))
-                struct_dir = Path(out_dir, 'structure')
-                struct_dir.mkdir(parents=True, exist_ok=True)
-                im_dir = Path(out_dir, "table_images")
-                im_dir.mkdir(parents=True, exist_ok=True)
-                fpath = Path(struct_dir, filename)
-                with open(fpath, 'w') as f:
-                    json.dump(_table.to_json(), f, indent=2)
-                    print(f"wrote {fpath}")
-                # save table image for debugging
-                im_fpath = Path(im_dir, im_filename)
-                table_image.image.save(im_fpath)
-                print(f'saved {im_fpath}')
-
-            _tables.append(_table)
+                save_table_structure(_table, table_image, page_num, i + 1, out_dir, prefix, save_images)
         return _tables
 
     def save_table_images(self, page_jpg_list, out_dir, prefix):
@@ -193,27 +263,139 @@ class TableExtractor(object):
                 print(f"saved {fpath}.")
 
 
-def pdf_to_images(pdf_file_path, out_dir):
+def get_page_ranges(page_nums, num_chunks=1):
+    """
+    :param page_nums: 1 based page numbers
+    :param num_chunks: long runs of consecutive pages are split so that there are about that many ranges
+    :return: list of (first, last) page ranges covering the pages
+    """
+    pages = sorted(set(page_nums))
+    if not pages:
+        return []
+    max_len = max(1, -(-len(pages) // max(1, num_chunks)))
+    ranges = []
+    first = last = pages[0]
+    for page in pages[1:]:
+        if page == last + 1 and page - first < max_len:
+            last = page
+        else:
+            ranges.append((first, last))
+            first = last = page
+    ranges.append((first, last))
+    return ranges
+
+
+def get_page_num(image_file):
+    """:return: the page number (as formatted by pdftoppm) of a page image file"""
+    return re.search(r"-(\d+)\.jpg", image_file).group(1)
+
+
+def render_pdf_pages(pdf_file_path, page_ids=None, dpi=RENDER_DPI, out_dir=None):
+    """
+    Renders the pages of the PDF in process with PyMuPDF, without temporary files.
+    :param page_ids: 0 based indices of the pages to render, None for all pages
+    :param out_dir: if given, the page images are saved there as well (for debugging)
+    :return: list of (page number, PIL image) in page order, the page numbers are 1 based strings
+    """
+    page_images = []
+    with FITZ_LOCK, fitz.open(pdf_file_path) as doc:
+        if page_ids is None:
+            page_ids = range(doc.page_count)
+        for page_id in sorted(p for p in set(page_ids) if 0 <= p < doc.page_count):
+            check_current()
+            pix = doc[page_id].get_pixmap(dpi=dpi, alpha=False)
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            page_images.append((str(page_id + 1), image))
+    if out_dir:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        for page_num, image in page_images:
+            image.save(os.path.join(out_dir, "{}-{}.jpg".format(Path(pdf_file_path).stem, page_num)))
+    return page_images
+
+
+def render_table_images(pdf_file_path, page_num, boxes, detect_dpi, structure_dpi, offset=TABLE_MARGIN):
+    """
+    Renders the table regions detected on a page image rendered at detect_dpi at the higher
+    structure_dpi resolution (clip rendering), so that only the tables are rendered sharp.
+    :param page_num: 1 based page number
+    :param boxes: (xmin, ymin, xmax, ymax) table boxes in pixels of the page image rendered at detect_dpi
+    :param offset: margin around the tables in pixels at RENDER_DPI
+    :return: the table images with their bounds in pixels of the page rendered at structure_dpi and the
+             width and height of that page (the frame the structure JSON coordinates are in)
+    """
+    zoom = structure_dpi / 72.0
+    matrix = fitz.Matrix(zoom, zoom)
+    margin = offset * 72.0 / RENDER_DPI
+    table_images = []
+    with FITZ_LOCK, fitz.open(pdf_file_path) as doc:
+        page = doc[int(page_num) - 1]
+        page_rect = page.rect
+        for (xmin, ymin, xmax, ymax) in boxes:
+            # page image pixels to PDF points
+            clip = fitz.Rect(xmin, ymin, xmax, ymax) * (72.0 / detect_dpi)
+            clip = fitz.Rect(clip.x0 - margin, clip.y0 - margin, clip.x1 + margin, clip.y1 + margin) & page_rect
+            if clip.is_empty:
+                continue
+            pix = page.get_pixmap(matrix=matrix, clip=clip, alpha=False)
+            table_im = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            table_images.append(TableImage(image=table_im, left=pix.x, top=pix.y,
+                                           right=pix.x + pix.width, bottom=pix.y + pix.height))
+        page_width = int(round(page_rect.width * zoom))
+        page_height = int(round(page_rect.height * zoom))
+    return table_images, page_width, page_height
+
+
+def pdf_to_images(pdf_file_path, out_dir, page_ids=None, max_workers=RASTERIZE_WORKERS, dpi=RENDER_DPI):
+    """
+    Renders the pages of the PDF as JPEG images with pdftoppm.
+    :param page_ids: 0 based indices of the pages to render, None for all pages
+    :param dpi: resolution of the page images
+    :param max_workers: max number of pdftoppm processes rendering page ranges in parallel
+    :return: image files in page order
+    """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
     pdf_file = os.path.basename(pdf_file_path)
     pdf_file_stem = Path(pdf_file_path).stem
     new_path = os.path.join(out_dir, pdf_file)
     shutil.copyfile(pdf_file_path, new_path)
-    process = subprocess.run(['pdftoppm', pdf_file, pdf_file_stem, '-jpeg'], cwd=out_dir,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             universal_newlines=True)
+    if page_ids is None:
+        page_ranges = [None]
+    else:
+        page_ranges = get_page_ranges([p + 1 for p in page_ids], max_workers)
+        if not page_ranges:
+            return []
+    # run_subprocess() kills the pdftoppm processes of a cancelled job via the job control of this thread
+    control = get_current()
 
-    if process.returncode != 0:
-        print(process.stderr)
-        return []
+    def render(page_range):
+        set_current(control)
+        try:
+            range_args = ['-f', str(page_range[0]), '-l', str(page_range[1])] if page_range else []
+            return run_subprocess(['pdftoppm', '-r', str(dpi)] + range_args + [pdf_file, pdf_file_stem, '-jpeg'],
+                                  cwd=out_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+        finally:
+            set_current(None)
 
-    def page_num_order(el):
-        return int(re.search(r"-(\d+)\.jpg", el).group(1))
+    if len(page_ranges) == 1:
+        processes = [render(page_ranges[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(page_ranges))) as executor:
+            processes = list(executor.map(render, page_ranges))
+    for process in processes:
+        if process.returncode != 0:
+            print(process.stderr)
+            return []
 
-    image_files = [os.path.join(out_dir, f) for f in os.listdir(out_dir) if re.match(r'.+\.jpg', f)]
-    image_files.sort(key=page_num_order)
-    return image_files
+    page_nums = None if page_ids is None else {p + 1 for p in page_ids}
+    image_files = []
+    for f in os.listdir(out_dir):
+        m = re.match(re.escape(pdf_file_stem) + r"-(\d+)\.jpg$", f)
+        if m and (page_nums is None or int(m.group(1)) in page_nums):
+            image_files.append((int(m.group(1)), os.path.join(out_dir, f)))
+    image_files.sort()
+    return [f for _, f in image_files]
 
 
 def extract_save_tables(in_root_dir):
@@ -0,0 +1,72 @@
+import threading
+import traceback
+from queue import Queue
+
+from pdf_table_extractor_api import PDFTableExtractor, PaperContext, STAGES
+
+_SENTINEL = object()
+
+
+class StagedExtractionPipeline(object):
+    """
+    Runs the extraction stages of PDFTableExtractor concurrently for different papers. Each stage
+    has its own pool of worker threads fed by a bounded queue, so while paper N is in TATR paper N+1
+    can be rasterized and paper N-1 can be in the Java hybrid extractor. All pools share the models
+    of the given table extractor. The subprocess bound stages (detection data prep, pdftoppm, Java)
+    and torch inference release the GIL, so threads are enough to overlap them. PyMuPDF is not thread
+    safe, its rendering (pymupdf rasterize backend, table clip rendering) is serialized by FITZ_LOCK
+    and does not overlap with other PyMuPDF work in the process.
+    """
+    def __init__(self, table_extractor: PDFTableExtractor, pool_sizes: dict, queue_size=2, on_complete=None):
+        self.table_extractor = table_extractor
+        self.pool_sizes = {stage: max(1, int(pool_sizes.get(stage, 1))) for stage in STAGES}
+        self.on_complete = on_complete
+        self.queues = [Queue(maxsize=max(1, queue_size)) for _ in STAGES]
+        self.pools = []
+        for stage_idx, stage in enumerate(STAGES):
+            pool = [threading.Thread(target=self._stage_worker, args=(stage_idx,), daemon=True,
+                                     name=f"{stage}_{i}") for i in range(self.pool_sizes[stage])]
+            self.pools.append(pool)
+
+    def start(self):
+        for pool in self.pools:
+            for thread in pool:
+                thread.start()
+
+    def submit(self, ctx: PaperContext):
+        """Blocks while the first stage queue is full (back pressure)."""
+        self.queues[0].put(ctx)
+
+    def shutdown(self):
+        # stop the stages in order so that papers already in the pipeline are finished
+        for stage_idx, pool in enumerate(self.pools):
+            for _ in pool:
+                self.queues[stage_idx].put(_SENTINEL)
+            for thread in pool:
+                thread.join()
+
+    def _stage_worker(self, stage_idx):
+        stage = STAGES[stage_idx]
+        while True:
+            ctx = self.queues[stage_idx].get()
+            if ctx is _SENTINEL:
+                break
+            try:
+                self.table_extractor.run_stage(stage, ctx)
+            except Exception as err:
+                print(f"Error in stage {stage}: " + str(err))
+                print(traceback.format_exc())
+                self._complete(ctx, err)
+                continue
+            if ctx.done or stage_idx + 1 == len(STAGES):
+                self._complete(ctx, None)
+            else:
+                self.queues[stage_idx + 1].put(ctx)
+
+    def _complete(self, ctx: PaperContext, err):
+        try:
+            if self.on_complete:
+                self.on_complete(ctx, err)
+        except Exception as e:
+            print("Error in pipeline completion callback: " + str(e))
+            print(traceback.format_exc())
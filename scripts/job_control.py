@@ -0,0 +1,102 @@
+import os
+import time
+import signal
+import threading
+import subprocess
+
+# how often (secs) a running child process is checked for cancellation and deadline expiry
+POLL_INTERVAL = 0.5
+
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    """Raised in the extraction of a job cancelled by the user ('cancelled') or past its deadline ('timeout')."""
+    def __init__(self, reason, stage=None):
+        super().__init__(f"job {reason} in stage {stage}" if stage else f"job {reason}")
+        self.reason = reason
+        self.stage = stage
+
+
+class JobControl(object):
+    """
+    Cancellation token and deadline of a single job. The extraction checks it between steps and
+    the child processes started via run_subprocess() are killed (with their process group) as soon
+    as the job is cancelled or its deadline passes.
+    """
+    def __init__(self, deadline_secs=None):
+        self.deadline = time.monotonic() + deadline_secs if deadline_secs else None
+        self.stage = None
+        self.reason = None
+        self._procs = set()
+        self._lock = threading.Lock()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def cancel(self, reason='cancelled'):
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+            procs = list(self._procs)
+        for proc in procs:
+            kill_process_group(proc)
+
+    def check(self):
+        if self.reason is None and self.expired():
+            self.cancel('timeout')
+        if self.reason is not None:
+            raise JobCancelled(self.reason, self.stage)
+
+    def run(self, args, **kwargs):
+        """subprocess.run() replacement killing the child process group when the job is cancelled."""
+        self.check()
+        proc = subprocess.Popen(args, start_new_session=True, **kwargs)
+        with self._lock:
+            self._procs.add(proc)
+        try:
+            while True:
+                try:
+                    stdout, stderr = proc.communicate(timeout=POLL_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    if self.reason is None and self.expired():
+                        self.cancel('timeout')
+                    if self.reason is not None:
+                        kill_process_group(proc)
+                        proc.communicate()
+                        raise JobCancelled(self.reason, self.stage)
+        finally:
+            with self._lock:
+                self._procs.discard(proc)
+        self.check()
+        return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def set_current(control):
+    """Sets the job control of the calling (stage) thread used by run_subprocess() and check_current()."""
+    _local.control = control
+
+
+def get_current():
+    return getattr(_local, 'control', None)
+
+
+def check_current():
+    control = get_current()
+    if control:
+        control.check()
+
+
+def run_subprocess(args, **kwargs):
+    control = get_current()
+    if control:
+        return control.run(args, **kwargs)
+    return subprocess.run(args, **kwargs)
@@ -0,0 +1,80 @@
+import json
+import asyncio
+
+import asyncpg
+
+from pg_config import config
+
+# Postgres LISTEN/NOTIFY channel the workers publish job state transitions to (see task_manager.update_job)
+JOB_STATUS_CHANNEL = "job_status"
+
+
+class JobEventHub(object):
+    """
+    Listens to the job state transitions published by the workers over Postgres LISTEN/NOTIFY and
+    dispatches them to the long-poll and server-sent events requests waiting in this process.
+    """
+    def __init__(self):
+        self.conn = None
+        self.subscribers = set()
+        # callables receiving every job event (e.g. metrics)
+        self.listeners = []
+
+    async def start(self):
+        params = config()
+        self.conn = await asyncpg.connect(**params)
+        await self.conn.add_listener(JOB_STATUS_CHANNEL, self._on_notification)
+
+    async def stop(self):
+        if self.conn:
+            await self.conn.remove_listener(JOB_STATUS_CHANNEL, self._on_notification)
+            await self.conn.close()
+            self.conn = None
+
+    def subscribe(self, job_ids=None):
+        """
+        :param job_ids: the jobs of interest, None for all jobs
+        :return: subscription to be passed to unsubscribe() when done
+        """
+        subscription = JobSubscription(set(job_ids) if job_ids else None)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _on_notification(self, _conn, _pid, _channel, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            print(f"invalid job status notification payload: {payload}")
+            return
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as err:
+                print(f"job event listener error: {err}")
+        for subscription in list(self.subscribers):
+            subscription.offer(event)
+
+
+class JobSubscription(object):
+    def __init__(self, job_ids=None):
+        self.job_ids = job_ids
+        self.events = asyncio.Queue()
+
+    def offer(self, event):
+        if self.job_ids is None or event.get('job_id') in self.job_ids:
+            self.events.put_nowait(event)
+
+    async def next_event(self, timeout):
+        """
+        :return: the next job event or None on timeout
+        """
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
@@ -0,0 +1,45 @@
+import signal
+import threading
+from pathlib import Path
+
+import click
+
+from pg_config import get_rm_model_dir, get_num_workers, get_health_check_interval
+from pg_config import get_poll_interval, get_stale_claim_timeout, get_pipeline_config, get_job_deadline
+from pg_config import get_priority_weights, get_scheduling_policy, get_max_attempts, get_auto_retries
+from pg_config import get_recycle_limits
+from task_manager import TaskManager
+
+
+@click.command(help="standalone extraction worker claiming jobs from the Postgres job queue")
+@click.option('-n', '--num-workers', type=int, default=None,
+              help="number of worker processes (default: num-workers from the ini file)")
+def run_workers(num_workers):
+    if num_workers is None:
+        num_workers = get_num_workers()
+    task_manager = TaskManager(Path(get_rm_model_dir()), num_workers=num_workers,
+                               health_check_interval=get_health_check_interval(), queue_mode='db',
+                               poll_interval=get_poll_interval(),
+                               stale_claim_timeout=get_stale_claim_timeout(),
+                               pipeline_config=get_pipeline_config(), job_deadline=get_job_deadline(),
+                               priority_weights=get_priority_weights(),
+                               scheduling_policy=get_scheduling_policy(), max_attempts=get_max_attempts(),
+                               max_retries=get_auto_retries(), recycle_limits=get_recycle_limits())
+    done = threading.Event()
+
+    def handle_signal(signum, _frame):
+        print(f"got signal {signum}, shutting down workers...", flush=True)
+        done.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    task_manager.start()
+    print(f"started {num_workers} DB queue worker(s).", flush=True)
+    while not done.wait(1):
+        pass
+    task_manager.shutdown()
+    print("shut down workers.", flush=True)
+
+
+if __name__ == '__main__':
+    run_workers()
@@ -0,0 +1,132 @@
+import threading
+
+# Minimal Prometheus text exposition format (version 0.0.4) metrics, fed by the job state transitions
+# the workers publish (see job_events.JobEventHub) and rendered by the /metrics endpoint of api.py.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple((n, labels[n]) for n in self.label_names)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(key)} {format_value(value)}")
+        return lines
+
+
+class Gauge(object):
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {format_value(self.value)}"]
+
+
+class Histogram(object):
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.label_names = tuple(label_names)
+        # label values -> [bucket counts, sum, count]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple((n, labels[n]) for n in self.label_names)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        entry = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (bucket_counts, total, count) in sorted(self.values.items()):
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                labels = key + (('le', format_value(bound)),)
+                lines.append(f"{self.name}_bucket{format_labels(labels)} {bucket_count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+class ExtractionMetrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs_completed = Counter("extraction_jobs_completed_total",
+                                      "Number of jobs that reached a final state", ["status"])
+        self.stage_seconds = Histogram("extraction_stage_duration_seconds",
+                                       "Wall time of the extraction stages per paper",
+                                       STAGE_SECONDS_BUCKETS, ["stage"])
+        self.stage_counts = Histogram("extraction_stage_work_items",
+                                      "Work items (pages, tables, cells, instances) per paper",
+                                      COUNT_BUCKETS, ["counter"])
+        self.cache_bytes_reclaimed = Counter("cache_bytes_reclaimed_total",
+                                             "Bytes reclaimed by removing work dirs from the server cache dir")
+        self.cache_dirs_evicted = Counter("cache_dirs_evicted_total",
+                                          "Work dirs removed from the server cache dir")
+        self.cache_bytes = Gauge("cache_bytes", "Size of the server cache dir at the last clean up")
+        self.metrics = [self.jobs_completed, self.stage_seconds, self.stage_counts, self.cache_bytes_reclaimed,
+                        self.cache_dirs_evicted, self.cache_bytes]
+
+    def observe_job_event(self, event):
+        """
+        :param event: job state transition as published by task_manager.notify_job_status
+        """
+        stats = event.get('stats')
+        if stats is None:
+            return
+        with self._lock:
+            self.jobs_completed.inc(status=event.get('job_status'))
+            for stage, secs in stats.get('timings', {}).items():
+                self.stage_seconds.observe(secs, stage=stage)
+            for counter, value in stats.get('counters', {}).items():
+                self.stage_counts.observe(value, counter=counter)
+
+    def observe_cache_eviction(self, num_dirs, reclaimed_bytes, cache_bytes):
+        with self._lock:
+            self.cache_dirs_evicted.inc(num_dirs)
+            self.cache_bytes_reclaimed.inc(reclaimed_bytes)
+            self.cache_bytes.set(cache_bytes)
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in self.metrics:
+                lines.extend(metric.render())
+            return "\n".join(lines) + "\n"
@@ -1,13 +1,16 @@
 import os
 import re
 import json
-import subprocess
+import time
+import hashlib
 from pathlib import Path
 
-from extract_tables_from_pdf import TableExtractor, pdf_to_images
+from extract_tables_from_pdf import TableExtractor, pdf_to_images, render_pdf_pages, render_table_images
+from extract_tables_from_pdf import get_page_num, load_page_image, extract_table_images, save_table_structure
 from rel_table_pages_filter import RelevantTablePagesDetector
 from row_merger import RowMerger
-from pg_config import get_work_dir
+from pg_config import get_work_dir, get_rasterize_config, get_tatr_config
+from job_control import JobControl, run_subprocess, set_current
 
 # global
 # HOME = os.path.expanduser('~')
@@ -17,16 +20,161 @@ WD = get_work_dir()
 
 def do_hybrid_table_content_extraction(_pdf_file_path, _struct_json_dir, _out_json_file,
                                        use_row_info=False):
-    wd = os.getcwd()
-    os.chdir(WD)
+    """Raises a RuntimeError if the Java extractor fails so that the stage is not checkpointed as done."""
+    # run with cwd instead of os.chdir() so that concurrent extractions (pipelined mode) are safe
     script_path = "hybrid_table_content_extractor.sh"
+    # an output left by an earlier attempt must not hide a failure
+    if os.path.isfile(_out_json_file):
+        os.remove(_out_json_file)
     if use_row_info:
-        subprocess.run(['bash', script_path, "-i", _pdf_file_path, '-o', _out_json_file,
-                        '-s', _struct_json_dir, '-r'])
+        process = run_subprocess(['bash', script_path, "-i", _pdf_file_path, '-o', _out_json_file,
+                                  '-s', _struct_json_dir, '-r'], cwd=WD)
     else:
-        subprocess.run(['bash', script_path, "-i", _pdf_file_path, '-o', _out_json_file,
-                        '-s', _struct_json_dir])
-    os.chdir(wd)
+        process = run_subprocess(['bash', script_path, "-i", _pdf_file_path, '-o', _out_json_file,
+                                  '-s', _struct_json_dir], cwd=WD)
+    if process.returncode != 0:
+        raise RuntimeError(f"hybrid table content extraction failed with exit code {process.returncode}")
+    if not os.path.isfile(_out_json_file):
+        raise RuntimeError(f"hybrid table content extraction did not write {_out_json_file}")
+
+
+def get_model_version(model_dir: Path):
+    """
+    :param model_dir: row merge model dir
+    :return: fingerprint of the model files in the models/ and the row merge model dirs and of the
+             page rendering settings used to key the cached extraction results
+    """
+    h = hashlib.sha256()
+    # the rendering backend and resolutions change the extracted coordinates and contents
+    rasterize_config = get_rasterize_config()
+    h.update("rasterize:{}:{}:{}\n".format(rasterize_config['backend'], rasterize_config['dpi'],
+                                           rasterize_config['structure_dpi']).encode())
+    for m_dir in [Path(WD, "models"), Path(model_dir)]:
+        if not m_dir.is_dir():
+            continue
+        for model_file in sorted(f for f in m_dir.rglob("*") if f.is_file()):
+            st = model_file.stat()
+            h.update("{}:{}:{}\n".format(model_file.relative_to(m_dir), st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()[:16]
+
+
+# extraction stages in the order they are run for a paper
+STAGES = ('detect', 'rasterize', 'tatr', 'hybrid', 'row_merge')
+# records the completed stages of a paper in its work dir so that a retry resumes after them
+MANIFEST_FILE = "stage_manifest.json"
+
+
+def get_pdf_fingerprint(pdf_file_path):
+    if not os.path.isfile(pdf_file_path):
+        return None
+    st = os.stat(pdf_file_path)
+    return "{}:{}".format(st.st_size, st.st_mtime_ns)
+
+
+class PaperContext(object):
+    """State of a single paper passed from one extraction stage to the next."""
+    def __init__(self, _pdf_file_path, _out_dir, use_row_info=False, job=None, control=None):
+        self.pdf_file_path = _pdf_file_path
+        self.out_dir = _out_dir
+        self.use_row_info = use_row_info
+        self.job = job
+        self.pdf_file_stem = Path(_pdf_file_path).stem
+        self.im_out_dir = os.path.join(_out_dir, self.pdf_file_stem)
+        self.struct_json_dir = Path(self.im_out_dir, 'structure')
+        self.out_json_file = Path(_out_dir, "table_report.json")
+        self.pages = []
+        self.image_files = []
+        # (page number, page image file or PIL image) of the pages to run TATR on
+        self.page_images = []
+        self.tables = []
+        self.result = None
+        # set by a stage when there is nothing left to do for the paper
+        self.done = False
+        # wall time (secs) per stage/sub-stage and work counters, stored with the job
+        self.timings = {}
+        self.counters = {}
+        # cancellation and deadline of the job, kills the child processes of the running stage
+        self.control = control if control else JobControl()
+        # number of automatic retries of the job so far
+        self.retries = 0
+        self.manifest_file = Path(_out_dir, MANIFEST_FILE)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        """:return: the stage manifest of an earlier attempt for the same PDF and params or an empty one"""
+        fingerprint = get_pdf_fingerprint(self.pdf_file_path)
+        if self.manifest_file.is_file():
+            try:
+                with open(self.manifest_file) as f:
+                    manifest = json.load(f)
+                if manifest.get('pdf') == fingerprint and manifest.get('use_row_info') == self.use_row_info:
+                    return manifest
+            except ValueError:
+                print(f"ignoring invalid stage manifest {self.manifest_file}")
+        return {'pdf': fingerprint, 'use_row_info': self.use_row_info, 'stages': {}}
+
+    def checkpoint(self, stage):
+        """Records the completion of the stage with the state the later stages need."""
+        state = {'done': self.done}
+        if stage == 'detect':
+            state['pages'] = self.pages
+        elif stage == 'rasterize':
+            if not self.image_files:
+                # rendered in memory, rendered again on resume
+                return
+            state['image_files'] = [str(f) for f in self.image_files]
+        elif stage == 'tatr':
+            state['num_tables'] = len(self.tables)
+        elif stage == 'hybrid':
+            state['has_result'] = self.result is not None
+        else:
+            # the result of the last stage is stored with the job
+            return
+        self.manifest['stages'][stage] = state
+        tmp_file = self.manifest_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_file, self.manifest_file)
+
+    def restore(self, stage):
+        """
+        Restores the state after the stage if it was completed in an earlier attempt and its outputs
+        are still in the work dir.
+        :return: True if the stage can be skipped
+        """
+        state = self.manifest['stages'].get(stage)
+        if state is None and stage == 'rasterize' and 'tatr' in self.manifest['stages']:
+            # rendered in memory and not checkpointed, but only TATR needs the page images
+            return True
+        if state is None:
+            return False
+        if stage == 'detect':
+            self.pages = state['pages']
+        elif stage == 'rasterize':
+            if not all(os.path.isfile(f) for f in state['image_files']):
+                return False
+            self.image_files = state['image_files']
+            self.page_images = [(get_page_num(f), f) for f in self.image_files]
+        elif stage == 'tatr':
+            if state['num_tables'] > 0 and not self.struct_json_dir.is_dir():
+                return False
+        elif stage == 'hybrid':
+            if state['has_result']:
+                if not self.out_json_file.is_file():
+                    return False
+                with open(self.out_json_file) as f:
+                    self.result = json.load(f)
+        self.done = state['done']
+        return True
+
+    def add_timing(self, name, secs):
+        self.timings[name] = self.timings.get(name, 0.0) + secs
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def get_stats(self):
+        return {'timings': {k: round(v, 4) for k, v in self.timings.items()}, 'counters': dict(self.counters)}
 
 
 class PDFTableExtractor(object):
@@ -34,43 +182,128 @@ class PDFTableExtractor(object):
         self.tex = TableExtractor()
         self.detector = RelevantTablePagesDetector()
         self.row_merger = RowMerger.create(model_dir)
+        self.rasterize_config = get_rasterize_config()
+        self.tatr_config = get_tatr_config()
+        self.stage_handlers = {'detect': self.detect_pages,
+                               'rasterize': self.rasterize,
+                               'tatr': self.extract_structures,
+                               'hybrid': self.extract_contents,
+                               'row_merge': self.merge_rows}
 
-    def extract_table_contents_from_pdf(self, _pdf_file_path, _out_dir, use_row_info=False):
-        pages = self.detector.get_relevant_pages(_pdf_file_path)
-        if len(pages) == 0:
-            return None
-        pdf_file_stem = Path(_pdf_file_path).stem
-        im_out_dir = os.path.join(_out_dir, pdf_file_stem)
-        Path(im_out_dir).mkdir(parents=True, exist_ok=True)
-        image_files = pdf_to_images(_pdf_file_path, im_out_dir)
-        page_ids = {p['page'] for p in pages}
-        all_tables = []
-        for image_file in image_files:
-            page_num = re.search(r"-(\d+)\.jpg", image_file).group(1)
-            page_no = int(page_num) - 1
-            if page_no in page_ids:
-                tables = self.tex.extract_tables_structures(image_file, out_dir=im_out_dir, prefix=pdf_file_stem)
-                if tables:
-                    all_tables.extend(tables)
-        if len(all_tables) == 0:
-            return None
+    def detect_pages(self, ctx: PaperContext):
+        pdf_inst_json_path = os.path.join(ctx.out_dir, 'pdf_line_clf_instances.json')
+        detect_stats = {}
+        ctx.pages = self.detector.get_relevant_pages(ctx.pdf_file_path, pdf_inst_json_path, stats=detect_stats)
+        ctx.count('instances_scored', detect_stats.get('instances_scored', 0))
+        ctx.count('pages_detected', len(ctx.pages))
+        if len(ctx.pages) == 0:
+            ctx.done = True
+
+    def rasterize(self, ctx: PaperContext):
+        Path(ctx.im_out_dir).mkdir(parents=True, exist_ok=True)
+        # only the pages detected as having key resource tables are rendered
+        page_ids = [p['page'] for p in ctx.pages]
+        if self.rasterize_config['backend'] == 'pdftoppm':
+            ctx.image_files = pdf_to_images(ctx.pdf_file_path, ctx.im_out_dir, page_ids=page_ids,
+                                            dpi=self.rasterize_config['dpi'])
+            ctx.page_images = [(get_page_num(f), f) for f in ctx.image_files]
+        else:
+            debug_dir = ctx.im_out_dir if self.rasterize_config['save_images'] else None
+            ctx.page_images = render_pdf_pages(ctx.pdf_file_path, page_ids, dpi=self.rasterize_config['dpi'],
+                                               out_dir=debug_dir)
+        ctx.count('pages_rasterized', len(ctx.page_images))
+
+    def extract_structures(self, ctx: PaperContext):
+        page_ids = {p['page'] for p in ctx.pages}
+        pages = [(page_num, page_image) for page_num, page_image in ctx.page_images
+                 if int(page_num) - 1 in page_ids]
+        # the tables of all candidate pages are detected in mini batches
+        start = time.perf_counter()
+        all_boxes = self.tex.detect_table_boxes_batch([page_image for _, page_image in pages],
+                                                      batch_size=self.tatr_config['detect_batch_size'])
+        ctx.add_timing('tatr_detect', time.perf_counter() - start)
+        ctx.count('pages_scanned', len(pages))
+        # the structures of the tables of all pages are recognized in mini batches
+        start = time.perf_counter()
+        crops = []
+        for (page_num, page_image), boxes in zip(pages, all_boxes):
+            if not boxes:
+                continue
+            ctx.control.check()
+            table_images, page_width, page_height = self.get_table_images(ctx, page_num, page_image, boxes)
+            for i, table_image in enumerate(table_images):
+                crops.append((page_num, i + 1, table_image, page_width, page_height))
+        tables = self.tex.extract_table_structures_batch([crop[2] for crop in crops],
+                                                         batch_size=self.tatr_config['structure_batch_size'])
+        for (page_num, table_no, table_image, page_width, page_height), table in zip(crops, tables):
+            table.set_page_info(page_width, page_height)
+            save_table_structure(table, table_image, page_num, table_no, ctx.im_out_dir, ctx.pdf_file_stem,
+                                 save_images=self.rasterize_config['save_images'])
+        ctx.add_timing('tatr_structure', time.perf_counter() - start)
+        if tables:
+            ctx.tables.extend(tables)
+            ctx.count('tables_found', len(tables))
+            ctx.count('cells', sum(len(row.cells) for t in tables for row in t.rows))
+        # the page images are not needed by the later stages
+        ctx.page_images = []
+        if len(ctx.tables) == 0:
+            ctx.done = True
+
+    def get_table_images(self, ctx: PaperContext, page_num, page_image, boxes):
+        """
+        :param boxes: the table boxes detected on the page image
+        :return: the table images with the page width and height (the frame of the table coordinates)
+        """
+        structure_dpi = self.rasterize_config['structure_dpi']
+        if structure_dpi:
+            # detected on the low resolution page image, only the table regions are rendered at structure_dpi
+            return render_table_images(ctx.pdf_file_path, page_num, boxes, self.rasterize_config['dpi'], structure_dpi)
+        image = load_page_image(page_image)
+        return extract_table_images(image, boxes), image.width, image.height
 
+    def extract_contents(self, ctx: PaperContext):
         # do hybrid table content extraction
-        struct_json_dir = Path(im_out_dir, 'structure')
-        if struct_json_dir.is_dir():
-            json_files = [os.path.join(struct_json_dir, f) for f in os.listdir(struct_json_dir) if
+        ctx.done = True
+        if ctx.struct_json_dir.is_dir():
+            json_files = [os.path.join(ctx.struct_json_dir, f) for f in os.listdir(ctx.struct_json_dir) if
                           re.match(r'.+\.json', f)]
             if len(json_files) == 0:
-                return None
-            out_json_file = Path(_out_dir, "table_report.json")
-            do_hybrid_table_content_extraction(_pdf_file_path, str(struct_json_dir),
-                                               str(out_json_file), use_row_info)
-            if out_json_file.is_file():
-                with open(out_json_file) as f:
-                    data = json.load(f)
-                if not use_row_info:
-                    print("***** doing row merging ****")
-                    data = self.row_merger.do_predict(data)
-                    print("=" * 80)
-                return data
-        return None
+                return
+            do_hybrid_table_content_extraction(ctx.pdf_file_path, str(ctx.struct_json_dir),
+                                               str(ctx.out_json_file), ctx.use_row_info)
+            with open(ctx.out_json_file) as f:
+                ctx.result = json.load(f)
+            ctx.done = False
+
+    def merge_rows(self, ctx: PaperContext):
+        if not ctx.use_row_info:
+            print("***** doing row merging ****")
+            ctx.result = self.row_merger.do_predict(ctx.result)
+            print("=" * 80)
+
+    def run_stage(self, stage, ctx: PaperContext):
+        ctx.control.stage = stage
+        ctx.control.check()
+        if ctx.restore(stage):
+            print(f"{ctx.pdf_file_stem}: skipping stage {stage} completed earlier", flush=True)
+            ctx.count('stages_skipped')
+            return
+        start = time.perf_counter()
+        set_current(ctx.control)
+        try:
+            self.stage_handlers[stage](ctx)
+        finally:
+            set_current(None)
+            ctx.add_timing(stage, time.perf_counter() - start)
+        ctx.checkpoint(stage)
+
+    def extract(self, ctx: PaperContext):
+        for stage in STAGES:
+            self.run_stage(stage, ctx)
+            if ctx.done:
+                break
+        return ctx.result
+
+    def extract_table_contents_from_pdf(self, _pdf_file_path, _out_dir, use_row_info=False):
+        ctx = PaperContext(_pdf_file_path, _out_dir, use_row_info=use_row_info)
+        return self.extract(ctx)
@@ -41,6 +41,138 @@ def get_server_cache_dir(filename="key_resource_table_extractor.ini"):
     return get_param(filename, "config", "server-cache-dir")
 
 
+def get_max_upload_size(filename="key_resource_table_extractor.ini"):
+    return int(float(get_param_or_default(filename, "config", "max-upload-size-mb", "500")) * 1024 * 1024)
+
+
+def get_max_batch_upload_size(filename="key_resource_table_extractor.ini"):
+    return int(float(get_param_or_default(filename, "config", "max-batch-upload-size-mb", "5000")) * 1024 * 1024)
+
+
+def get_num_workers(filename="key_resource_table_extractor.ini"):
+    return int(get_param_or_default(filename, "workers", "num-workers", "1"))
+
+
+def get_health_check_interval(filename="key_resource_table_extractor.ini"):
+    return float(get_param_or_default(filename, "workers", "health-check-interval", "5"))
+
+
+def get_job_deadline(filename="key_resource_table_extractor.ini"):
+    """:return: max wall time (secs) of a job, None for no deadline"""
+    deadline = float(get_param_or_default(filename, "workers", "job-deadline", "1800"))
+    return deadline if deadline > 0 else None
+
+
+def get_recycle_limits(filename="key_resource_table_extractor.ini"):
+    """
+    :return: number of jobs and resident memory in bytes after which a worker process is replaced
+             by a fresh one (None if not limited)
+    """
+    max_jobs = int(get_param_or_default(filename, "workers", "max-jobs-per-worker", "0"))
+    max_rss_mb = float(get_param_or_default(filename, "workers", "max-worker-rss-mb", "0"))
+    return (max_jobs if max_jobs > 0 else None,
+            int(max_rss_mb * 1024 * 1024) if max_rss_mb > 0 else None)
+
+
+def get_queue_mode(filename="key_resource_table_extractor.ini"):
+    return get_param_or_default(filename, "queue", "mode", "memory")
+
+
+def get_poll_interval(filename="key_resource_table_extractor.ini"):
+    return float(get_param_or_default(filename, "queue", "poll-interval", "2"))
+
+
+def get_stale_claim_timeout(filename="key_resource_table_extractor.ini"):
+    return float(get_param_or_default(filename, "queue", "stale-claim-timeout", "300"))
+
+
+def get_max_attempts(filename="key_resource_table_extractor.ini"):
+    """:return: max number of times a job is started before it is given up (after worker crashes/restarts)"""
+    return int(get_param_or_default(filename, "queue", "max-attempts", "3"))
+
+
+def get_auto_retries(filename="key_resource_table_extractor.ini"):
+    """:return: number of times a failed extraction is retried right away, resuming after its completed stages"""
+    return int(get_param_or_default(filename, "queue", "auto-retries", "1"))
+
+
+def get_max_queue_depth(filename="key_resource_table_extractor.ini"):
+    """:return: number of waiting jobs above which new submissions are rejected (0 for no limit)"""
+    return int(get_param_or_default(filename, "queue", "max-queue-depth", "1000"))
+
+
+def get_pipeline_config(filename="key_resource_table_extractor.ini"):
+    """
+    :return: per stage worker pool sizes and the stage queue size if pipelined execution is enabled,
+             None otherwise
+    """
+    section = "pipeline"
+    if get_param_or_default(filename, section, "enabled", "false").lower() not in ('true', 'yes', '1'):
+        return None
+    pool_sizes = {'detect': int(get_param_or_default(filename, section, "detect-workers", "1")),
+                  'rasterize': int(get_param_or_default(filename, section, "rasterize-workers", "2")),
+                  'tatr': int(get_param_or_default(filename, section, "tatr-workers", "1")),
+                  'hybrid': int(get_param_or_default(filename, section, "hybrid-workers", "2")),
+                  'row_merge': int(get_param_or_default(filename, section, "row-merge-workers", "1"))}
+    return {'pool_sizes': pool_sizes,
+            'queue_size': int(get_param_or_default(filename, section, "queue-size", "2"))}
+
+
+def get_rasterize_config(filename="key_resource_table_extractor.ini"):
+    """
+    :return: page rendering backend ('pymupdf' in process or 'pdftoppm'), the resolution of the page
+             images, the resolution the detected table regions are rendered at for structure recognition
+             (None to crop them from the page images) and whether the in process rendered page images
+             are saved to the work dir
+    """
+    section = "rasterize"
+    structure_dpi = int(get_param_or_default(filename, section, "structure-dpi", "0"))
+    return {'backend': get_param_or_default(filename, section, "backend", "pymupdf"),
+            'dpi': int(get_param_or_default(filename, section, "dpi", "150")),
+            'structure_dpi': structure_dpi if structure_dpi > 0 else None,
+            'save_images': get_param_or_default(filename, section, "save-images",
+                                                "false").lower() in ('true', 'yes', '1')}
+
+
+def get_tatr_config(filename="key_resource_table_extractor.ini"):
+    """:return: number of page images per table detection and of table images per structure recognition forward pass"""
+    section = "tatr"
+    return {'detect_batch_size': max(1, int(get_param_or_default(filename, section, "detect-batch-size", "8"))),
+            'structure_batch_size': max(1, int(get_param_or_default(filename, section, "structure-batch-size",
+                                                                    "8")))}
+
+
+def get_priority_weights(filename="key_resource_table_extractor.ini"):
+    """:return: weighted fair share of the job priority classes"""
+    section = "scheduler"
+    return {'interactive': int(get_param_or_default(filename, section, "interactive-weight", "16")),
+            'normal': int(get_param_or_default(filename, section, "normal-weight", "4")),
+            'bulk': int(get_param_or_default(filename, section, "bulk-weight", "1"))}
+
+
+def get_scheduling_policy(filename="key_resource_table_extractor.ini"):
+    """:return: order of the waiting jobs within a priority class, 'fifo' or 'sjf' (shortest job first)"""
+    return get_param_or_default(filename, "scheduler", "policy", "fifo").lower()
+
+
+def get_aging_rate(filename="key_resource_table_extractor.ini"):
+    """:return: pages per minute of waiting by which the estimated cost of a job is lowered (sjf policy)"""
+    return float(get_param_or_default(filename, "scheduler", "aging-pages-per-min", "2"))
+
+
+def get_cache_limits(filename="key_resource_table_extractor.ini"):
+    """
+    :return: max size in bytes and TTL in secs of the server cache dir (None if not limited) and the
+             interval of the clean ups in secs
+    """
+    section = "cache"
+    max_size_gb = float(get_param_or_default(filename, section, "max-size-gb", "0"))
+    ttl_hours = float(get_param_or_default(filename, section, "ttl-hours", "0"))
+    interval = float(get_param_or_default(filename, section, "clean-up-interval", "600"))
+    return (int(max_size_gb * 1024 * 1024 * 1024) if max_size_gb > 0 else None,
+            ttl_hours * 3600 if ttl_hours > 0 else None, interval)
+
+
 def get_param(filename, section, param_key: str):
     parser = ConfigParser()
     parser.read(filename)
@@ -48,3 +180,11 @@ def get_param(filename, section, param_key: str):
         return parser.get(section, param_key)
     else:
         raise Exception('Section {0} not found in the {1} file'.format(section, filename))
+
+
+def get_param_or_default(filename, section, param_key: str, default):
+    parser = ConfigParser()
+    parser.read(filename)
+    if parser.has_option(section, param_key):
+        return parser.get(section, param_key)
+    return default
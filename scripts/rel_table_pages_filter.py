@@ -6,6 +6,7 @@ from table_detect_data_prep_batch import do_data_prep
 from classifier import PDFLineClassifier
 from stacked_gen import RelTablePageClassifier
 from pg_config import get_work_dir
+from job_control import JobCancelled
 
 
 # HOME = os.path.expanduser('~')
@@ -19,13 +20,19 @@ class RelevantTablePagesDetector(object):
         self.pl_clf = PDFLineClassifier(pdf_line_clf_model_path)
         self.clf = RelTablePageClassifier()
 
-    def get_relevant_pages(self, _pdf_file_path):
-        pdf_inst_json_path = '/tmp/pdf_line_clf_instances.json'
+    def get_relevant_pages(self, _pdf_file_path, pdf_inst_json_path='/tmp/pdf_line_clf_instances.json', stats=None):
+        """
+        :param stats: optional dict to which the number of candidate page instances scored is added
+        """
         try:
             do_data_prep(_pdf_file_path, pdf_inst_json_path)
             stack_instances = self.pl_clf.prep_stack_instances(pdf_inst_json_path)
+            if stats is not None:
+                stats['instances_scored'] = len(stack_instances)
             # import pdb; pdb.set_trace()
             return self.clf.get_detected_pages(stack_instances)
+        except JobCancelled:
+            raise
         except:
             print("An error occurred: ", sys.exc_info()[0])
             print(traceback.format_exc())
@@ -0,0 +1,110 @@
+import heapq
+import itertools
+import threading
+from collections import deque
+
+# job priority classes, most urgent first
+PRIORITY_CLASSES = ('interactive', 'normal', 'bulk')
+DEFAULT_PRIORITY = 'normal'
+# page count assumed for PDFs whose page count could not be read
+DEFAULT_PAGE_COUNT = 20
+
+
+def job_cost_key(page_count, submit_time, aging_rate):
+    """
+    Sort key of the shortest job first policy: the page count lowered by aging_rate pages per minute
+    of waiting. As all jobs age at the same rate, page_count - aging_rate * (now - submit_time) orders
+    the jobs like the static key below and big jobs are eventually served.
+    :param submit_time: epoch secs
+    """
+    if page_count is None:
+        page_count = DEFAULT_PAGE_COUNT
+    return page_count + aging_rate * submit_time / 60.0
+
+
+class SmoothWeightedRoundRobin(object):
+    """
+    Smooth weighted round robin (as in nginx upstream balancing). Over any window each class with
+    pending work is picked proportionally to its weight and the picks of a class are spread out
+    instead of being served in bursts.
+    """
+    def __init__(self, weights: dict):
+        self.weights = {c: max(1, int(weights.get(c, 1))) for c in PRIORITY_CLASSES}
+        self.current = {c: 0 for c in PRIORITY_CLASSES}
+
+    def next(self, candidates):
+        """
+        :param candidates: priority classes with pending jobs
+        :return: the class to serve next or None if there are no candidates
+        """
+        if not candidates:
+            return None
+        total = 0
+        best = None
+        for c in candidates:
+            self.current[c] += self.weights[c]
+            total += self.weights[c]
+            if best is None or self.current[c] > self.current[best]:
+                best = c
+        self.current[best] -= total
+        return best
+
+    def preference_order(self, candidates):
+        """:return: the candidates with the next class to serve first, the others by descending weight"""
+        first = self.next(candidates)
+        if first is None:
+            return []
+        rest = sorted((c for c in candidates if c != first), key=lambda c: -self.weights[c])
+        return [first] + rest
+
+
+class PriorityJobScheduler(object):
+    """
+    Per priority class job queues of the in-memory queue mode served by weighted fair share, so that
+    an interactive submission is not stuck behind thousands of queued bulk jobs.
+    """
+    def __init__(self, weights: dict, policy='fifo'):
+        """
+        :param policy: 'fifo' or 'sjf' to order the jobs of a class by their cost_key (see job_cost_key())
+        """
+        self.policy = policy
+        self.queues = {c: (ShortestJobFirstQueue() if policy == 'sjf' else deque()) for c in PRIORITY_CLASSES}
+        self.rr = SmoothWeightedRoundRobin(weights)
+        self._cond = threading.Condition()
+
+    def put(self, job):
+        priority = job.get('priority') or DEFAULT_PRIORITY
+        with self._cond:
+            self.queues[priority].append(job)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """:return: the next job to run or None on timeout"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: any(self.queues.values()), timeout):
+                return None
+            priority = self.rr.next([c for c in PRIORITY_CLASSES if self.queues[c]])
+            return self.queues[priority].popleft()
+
+    def qsize(self):
+        with self._cond:
+            return sum(len(q) for q in self.queues.values())
+
+
+class ShortestJobFirstQueue(object):
+    """Job queue ordered by the cost_key of the jobs (FIFO among equal keys), deque like interface."""
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+
+    def append(self, job):
+        # jobs without a cost estimate (e.g. queued before sjf was enabled) go first, as in db mode
+        # (cost_key nulls first), so that they cannot starve
+        cost_key = job.get('cost_key')
+        heapq.heappush(self._heap, (cost_key if cost_key is not None else float('-inf'), next(self._seq), job))
+
+    def popleft(self):
+        return heapq.heappop(self._heap)[2]
+
+    def __len__(self):
+        return len(self._heap)
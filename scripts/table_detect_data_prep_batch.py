@@ -1,19 +1,16 @@
 import os
 import shutil
-import subprocess
 from pathlib import Path
 from data_prep import load_list
+from job_control import run_subprocess
 
 HOME = os.path.expanduser('~')
 WD = os.path.join(HOME, "dev/java/pdf_table_extractor")
 
 
 def do_data_prep(_pdf_file, _out_json_file):
-    wd = os.getcwd()
-    os.chdir(WD)
     script_path = "table_detect_data_prep.sh"
-    subprocess.run(['bash', script_path, "-i", _pdf_file, '-o', _out_json_file])
-    os.chdir(wd)
+    run_subprocess(['bash', script_path, "-i", _pdf_file, '-o', _out_json_file], cwd=WD)
 
 
 def handle_rrid_papers_sample_200_03_07_2023(_papers_file, _out_dir):
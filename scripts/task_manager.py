@@ -1,21 +1,42 @@
+import os
 import json
 import time
+import socket
+import threading
 import traceback
 from pathlib import Path
 
 import psycopg
+import requests
 import asyncio
 import asyncpg
-from multiprocessing import Queue, Process
-from pg_config import config
+from multiprocessing import Queue, Process, Array, Event as MPEvent
+from queue import Empty, Full
+from pg_config import config, get_server_cache_dir
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from pdf_table_extractor_api import PDFTableExtractor
+from pdf_table_extractor_api import PDFTableExtractor, PaperContext
+from extraction_pipeline import StagedExtractionPipeline
+from job_events import JOB_STATUS_CHANNEL
+from job_control import JobControl, JobCancelled
+from scheduler import PriorityJobScheduler, SmoothWeightedRoundRobin, PRIORITY_CLASSES, DEFAULT_PRIORITY
+from scheduler import job_cost_key
 
 Job = namedtuple("Job", "id job_status start_time job_detail_id")
 JobDetail = namedtuple("JobDetail", "id paper_id pdf_file err_msg last_modified tables_data")
 
+HEARTBEAT_INTERVAL = 10
+WEBHOOK_MAX_ATTEMPTS = 3
+# job states after which a job does not change anymore
+FINAL_JOB_STATES = ('finished', 'error', 'cancelled', 'timeout')
+# final job states from which a job can be retried
+RETRYABLE_JOB_STATES = ('error', 'cancelled', 'timeout')
+# worker recycling states (see WorkerStatus)
+RECYCLE_NONE, RECYCLE_REQUESTED, RECYCLE_STANDBY_READY, RECYCLE_HANDED_OVER = range(4)
+# how often (secs) a pre-warmed replacement worker checks whether it can take over
+HANDOVER_POLL_INTERVAL = 0.2
+
 
 def consumer_test(queue: Queue):
     print("Consumer running", flush=True)
@@ -28,75 +49,735 @@ def consumer_test(queue: Queue):
     print("consumer done", flush=True)
 
 
-def job_consumer(queue: Queue, model_dir: Path):
+def finish_job(_con, job, result_json=None, err=None, stats=None):
+    """
+    :param stats: per stage timings and work counters of the extraction (see PaperContext.get_stats())
+    """
+    _job_id = job['job_id']
+    if isinstance(err, JobCancelled):
+        # 'cancelled' or 'timeout'
+        update_job(_con, _job_id, err.reason, _err_msg=str(err), _stats=stats, _stage=err.stage)
+        post_webhook(job, err.reason, _err_msg=str(err))
+        return
+    if err is not None:
+        update_job(_con, _job_id, 'error', _err_msg=str(err), _stats=stats)
+        post_webhook(job, 'error', _err_msg=str(err))
+        return
+    if result_json:
+        rj_str = json.dumps(result_json, separators=(',', ':'))
+    else:
+        rj_str = "{}"
+    print(rj_str)
+    print('---------------')
+    update_job(_con, _job_id, 'finished', _results_json=rj_str, _stats=stats)
+    # an empty result can also come from a step failing silently (e.g. the page detection),
+    # do not serve it to all later submissions of the PDF
+    if result_json:
+        cache_job_result(_con, _job_id)
+    post_webhook(job, 'finished')
+
+
+def post_webhook(job, _job_status, _err_msg=None):
+    """
+    Notifies the webhook URL given at submission (if any) about the job completion in a background
+    thread so that slow receivers do not hold up the worker.
+    """
+    url = job.get('webhook_url')
+    if not url:
+        return
+    payload = {'job_id': job['job_id'], 'paper_id': job.get('paper_id'), 'job_status': _job_status,
+               'err_msg': _err_msg}
+
+    def _post():
+        for attempt in range(WEBHOOK_MAX_ATTEMPTS):
+            try:
+                response = requests.post(url, json=payload, timeout=10)
+                if response.status_code < 400:
+                    return
+                print(f"webhook {url} returned {response.status_code} for job {job['job_id']}", flush=True)
+            except requests.RequestException as error:
+                print(f"webhook {url} failed for job {job['job_id']}: {error}", flush=True)
+            time.sleep(2 ** attempt)
+
+    threading.Thread(target=_post, daemon=True).start()
+
+
+def process_job(table_extractor: PDFTableExtractor, _con, job, control=None, max_retries=0):
+    """
+    :param max_retries: number of times a failed extraction is retried, resuming after the completed stages
+    """
+    for attempt in range(max_retries + 1):
+        ctx = PaperContext(Path(job['work_dir'], job['pdf_file']), job['work_dir'],
+                           use_row_info=job['use_row_info'], job=job, control=control)
+        try:
+            result_json = table_extractor.extract(ctx)
+            finish_job(_con, job, result_json, stats=ctx.get_stats())
+            return
+        except JobCancelled as err:
+            finish_job(_con, job, err=err, stats=ctx.get_stats())
+            return
+        except Exception as err:
+            print("Error during Resources table extraction: " + str(err))
+            print(traceback.format_exc())
+            if attempt < max_retries:
+                print(f"retrying job {job['job_id']} from stage {control.stage if control else None}", flush=True)
+                continue
+            finish_job(_con, job, err=err, stats=ctx.get_stats())
+
+
+class JobHeartbeat(object):
+    """
+    Background thread of a worker process periodically refreshing the heartbeat of the jobs
+    being processed so that the claims of crashed or hung workers can be reclaimed.
+    """
+    def __init__(self, interval=HEARTBEAT_INTERVAL, on_beat=None, on_cancel=None):
+        """
+        :param on_cancel: called with the id of each running job the user requested to cancel
+        """
+        self.interval = interval
+        self.on_beat = on_beat
+        self.on_cancel = on_cancel
+        self._job_ids = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def add_job(self, _job_id):
+        with self._lock:
+            self._job_ids.add(_job_id)
+
+    def remove_job(self, _job_id):
+        with self._lock:
+            self._job_ids.discard(_job_id)
+
+    def _run(self):
+        _con = None
+        try:
+            while not self._stop_event.wait(self.interval):
+                with self._lock:
+                    job_ids = list(self._job_ids)
+                if job_ids:
+                    # a dropped connection (e.g. a DB restart) must not stop the heartbeats, otherwise the
+                    # jobs of this worker are reclaimed and run twice. Reconnect on the next beat.
+                    try:
+                        if _con is None or _con.closed:
+                            _con = connect()
+                        cancel_requested = touch_job_heartbeat(_con, job_ids)
+                    except (Exception, psycopg.Error) as error:
+                        print("Job heartbeat error", error, flush=True)
+                        cancel_requested = []
+                        if _con:
+                            try:
+                                _con.close()
+                            except psycopg.Error:
+                                pass
+                        _con = None
+                    if self.on_cancel:
+                        for _job_id in cancel_requested:
+                            self.on_cancel(_job_id)
+                if self.on_beat:
+                    self.on_beat()
+        finally:
+            if _con:
+                _con.close()
+
+
+class JobRunner(object):
+    """
+    Runs the jobs of a worker process, either one at a time or, when a pipeline config is
+    given, through a StagedExtractionPipeline with several papers in flight. The models are
+    loaded on construction, the runner accepts jobs after start().
+    """
+    def __init__(self, model_dir: Path, worker_idx=0, worker_status=None, pipeline_config=None, job_deadline=None,
+                 max_retries=0):
+        self.worker_idx = worker_idx
+        self.worker_status = worker_status
+        self.job_deadline = job_deadline
+        self.max_retries = max_retries
+        self.table_extractor = PDFTableExtractor(model_dir)
+        self._con = connect()
+        self._con_lock = threading.Lock()
+        # job id -> JobControl of the jobs in flight
+        self.controls = {}
+        self.jobs_run = 0
+        self.started = False
+        # set on close(), failed jobs are no longer resubmitted to the pipeline once it shuts down
+        self.closing = False
+        self._retry_lock = threading.Lock()
+        self._retry_threads = []
+        if worker_status:
+            self.heartbeat = JobHeartbeat(on_beat=lambda: worker_status.beat(worker_idx),
+                                          on_cancel=self._cancel_job)
+        else:
+            self.heartbeat = JobHeartbeat(on_cancel=self._cancel_job)
+        self.pipeline = None
+        if pipeline_config:
+            self.pipeline = StagedExtractionPipeline(self.table_extractor, pipeline_config['pool_sizes'],
+                                                     queue_size=pipeline_config['queue_size'],
+                                                     on_complete=self._on_pipeline_complete)
+
+    def start(self):
+        if self.worker_status:
+            self.worker_status.worker_started(self.worker_idx)
+        self.heartbeat.start()
+        if self.pipeline:
+            self.pipeline.start()
+        self.started = True
+
+    def run(self, job):
+        """In pipelined mode returns as soon as the job is accepted by the first stage."""
+        control = JobControl(self.job_deadline)
+        self.jobs_run += 1
+        self._job_started(job, control)
+        if self.pipeline:
+            ctx = PaperContext(Path(job['work_dir'], job['pdf_file']), job['work_dir'],
+                               use_row_info=job['use_row_info'], job=job, control=control)
+            self.pipeline.submit(ctx)
+            return
+        try:
+            process_job(self.table_extractor, self._con, job, control, self.max_retries)
+        finally:
+            self._job_finished(job)
+
+    def _cancel_job(self, _job_id):
+        control = self.controls.get(_job_id)
+        if control:
+            print(f"cancelling job {_job_id}", flush=True)
+            control.cancel('cancelled')
+
+    def _on_pipeline_complete(self, ctx: PaperContext, err):
+        if err is not None and not isinstance(err, JobCancelled) and ctx.retries < self.max_retries:
+            with self._retry_lock:
+                if not self.closing:
+                    retry_ctx = PaperContext(ctx.pdf_file_path, ctx.out_dir, use_row_info=ctx.use_row_info,
+                                             job=ctx.job, control=ctx.control)
+                    retry_ctx.retries = ctx.retries + 1
+                    print(f"retrying job {ctx.job['job_id']} from stage {ctx.control.stage}", flush=True)
+                    # submitted from another thread as a stage thread must not block on the first stage queue
+                    thread = threading.Thread(target=self.pipeline.submit, args=(retry_ctx,), daemon=True)
+                    thread.start()
+                    self._retry_threads = [t for t in self._retry_threads if t.is_alive()] + [thread]
+                    return
+            print(f"not retrying job {ctx.job['job_id']}, the worker is shutting down", flush=True)
+        try:
+            with self._con_lock:
+                finish_job(self._con, ctx.job, ctx.result, err, stats=ctx.get_stats())
+        finally:
+            self._job_finished(ctx.job)
+
+    def _job_started(self, job, control):
+        self.controls[job['job_id']] = control
+        if self.worker_status:
+            self.worker_status.job_started(self.worker_idx, job['job_id'])
+        self.heartbeat.add_job(job['job_id'])
+
+    def _job_finished(self, job):
+        self.heartbeat.remove_job(job['job_id'])
+        self.controls.pop(job['job_id'], None)
+        if self.worker_status:
+            self.worker_status.job_finished(self.worker_idx, job['job_id'])
+
+    def needs_recycling(self, recycle_limits):
+        """
+        :param recycle_limits: max number of jobs and max resident memory in bytes of the worker process
+        :return: the reason the worker process should be replaced or None
+        """
+        if not recycle_limits:
+            return None
+        max_jobs, max_rss = recycle_limits
+        if max_jobs and self.jobs_run >= max_jobs:
+            return f"ran {self.jobs_run} jobs"
+        rss = get_rss_bytes() if max_rss else None
+        if rss and rss > max_rss:
+            return f"resident memory {rss // (1024 * 1024)} MB"
+        return None
+
+    def close(self):
+        with self._retry_lock:
+            self.closing = True
+            retry_threads = self._retry_threads
+            self._retry_threads = []
+        if self.started:
+            if self.pipeline:
+                # the stage threads are still running, so the pending resubmissions get into the first stage
+                for thread in retry_threads:
+                    thread.join()
+                self.pipeline.shutdown()
+            self.heartbeat.stop()
+        if self._con:
+            self._con.close()
+
+
+def get_rss_bytes():
+    """:return: resident memory of the calling process in bytes (None if not available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_worker_name(worker_idx, pid=None):
+    """:param pid: pid of the worker process, defaults to the calling process"""
+    return "{}:{}:{}".format(socket.gethostname(), pid if pid else os.getpid(), worker_idx)
+
+
+def job_consumer(queue: Queue, model_dir: Path, worker_idx=0, worker_status=None, pipeline_config=None,
+                 job_deadline=None, max_retries=0, recycle_limits=None, standby=False, stop_event=None):
+    """
+    :param recycle_limits: max number of jobs and max resident memory in bytes after which the worker
+                           asks to be replaced by a fresh process
+    :param standby: if True, the worker loads the models and waits for the worker it replaces to hand over
+    :param stop_event: stops a standby worker waiting for the handover
+    """
     _con = None
+    runner = None
+    retiring = False
     try:
         _con = connect()
-        table_extractor = PDFTableExtractor(model_dir)
-        print("Consumer running", flush=True)
+        runner = JobRunner(model_dir, worker_idx, worker_status, pipeline_config, job_deadline, max_retries)
+        if standby and not wait_for_handover(worker_status, worker_idx, stop_event):
+            return
+        runner.start()
+        worker_name = get_worker_name(worker_idx)
+        print(f"Consumer {worker_idx} running", flush=True)
         while True:
             try:
-                job = queue.get()
-                if job and "sentinel" in job.keys():
-                    print("consumer exiting", flush=True)
+                if worker_status and worker_status.should_retire(worker_idx):
+                    print(f"consumer {worker_idx} retiring, handing over to its replacement", flush=True)
+                    retiring = True
                     break
-                print(f"got {job}", flush=True)
                 try:
-                    _pdf_file_path = Path(job['work_dir'], job['pdf_file'])
-                    result_json = table_extractor.extract_table_contents_from_pdf(_pdf_file_path, job['work_dir'],
-                                                                                  use_row_info=job['use_row_info'])
-                    _job_id = job['job_id']
-                    if result_json:
-                        rj_str = json.dumps(result_json, indent=2)
-                    else:
-                        rj_str = "{}"
-                    print(rj_str)
-                    print('---------------')
-                    update_job(_con, _job_id, 'finished', _results_json=rj_str)
-                except Exception as err:
-                    print("Error during Resources table extraction: " + str(err))
-                    print(traceback.format_exc())
-                    update_job(_con, job['job_id'], 'error', _err_msg=str(err))
+                    job = queue.get(timeout=HEARTBEAT_INTERVAL)
+                except Empty:
+                    continue
+                if job and "sentinel" in job.keys():
+                    print(f"consumer {worker_idx} exiting", flush=True)
+                    break
+                print(f"worker {worker_idx} got {job}", flush=True)
+                if not mark_job_running(_con, job['job_id'], worker_name):
+                    print(f"job {job['job_id']} is no longer waiting, skipping.", flush=True)
+                    continue
+                runner.run(job)
+                check_recycling(runner, worker_status, worker_idx, recycle_limits)
             except (KeyboardInterrupt, SystemExit):
                 print("consumer exiting on system exit/keyboard interrupt ...")
                 break
-        print("consumer done.", flush=True)
+        print(f"consumer {worker_idx} done.", flush=True)
     finally:
+        if runner:
+            runner.close()
         if _con:
             _con.close()
             print("job consumer: connection closed.", flush=True)
+        if retiring:
+            worker_status.hand_over(worker_idx)
+
+
+def db_job_consumer(stop_event, model_dir: Path, worker_idx=0, worker_status=None,
+                    poll_interval=2.0, stale_claim_timeout=300.0, pipeline_config=None, job_deadline=None,
+                    priority_weights=None, scheduling_policy='fifo', max_attempts=3, max_retries=0,
+                    recycle_limits=None, standby=False):
+    """
+    :param recycle_limits: max number of jobs and max resident memory in bytes after which the worker
+                           asks to be replaced by a fresh process
+    :param standby: if True, the worker loads the models and waits for the worker it replaces to hand over
+    """
+    _con = None
+    runner = None
+    retiring = False
+    try:
+        _con = connect()
+        runner = JobRunner(model_dir, worker_idx, worker_status, pipeline_config, job_deadline, max_retries)
+        if standby and not wait_for_handover(worker_status, worker_idx, stop_event):
+            return
+        runner.start()
+        worker_name = get_worker_name(worker_idx)
+        # each worker serves the priority classes by weighted fair share
+        rr = SmoothWeightedRoundRobin(priority_weights or {})
+        print(f"DB queue consumer {worker_name} running", flush=True)
+        last_reclaim = 0
+        while not stop_event.is_set():
+            try:
+                if worker_status and worker_status.should_retire(worker_idx):
+                    print(f"DB queue consumer {worker_name} retiring, handing over to its replacement", flush=True)
+                    retiring = True
+                    break
+                if time.time() - last_reclaim > stale_claim_timeout / 2:
+                    reclaim_stale_jobs(_con, stale_claim_timeout, max_attempts)
+                    last_reclaim = time.time()
+                priorities = rr.preference_order(get_waiting_priority_classes(_con))
+                job = claim_job(_con, worker_name, priorities, scheduling_policy) if priorities else None
+                if job is None:
+                    stop_event.wait(poll_interval)
+                    continue
+                print(f"worker {worker_name} claimed {job}", flush=True)
+                runner.run(job)
+                check_recycling(runner, worker_status, worker_idx, recycle_limits)
+            except (KeyboardInterrupt, SystemExit):
+                print("consumer exiting on system exit/keyboard interrupt ...")
+                break
+            except psycopg.Error as error:
+                print("Database error", error)
+                _con.rollback()
+                stop_event.wait(poll_interval)
+        print(f"DB queue consumer {worker_name} done.", flush=True)
+    finally:
+        if runner:
+            runner.close()
+        if _con:
+            _con.close()
+            print("job consumer: connection closed.", flush=True)
+        if retiring:
+            worker_status.hand_over(worker_idx)
+
+
+def check_recycling(runner: JobRunner, worker_status, worker_idx, recycle_limits):
+    """Asks the task manager to pre-warm a replacement if the worker process reached its recycling limits."""
+    if worker_status is None:
+        return
+    reason = runner.needs_recycling(recycle_limits)
+    if reason and worker_status.request_recycling(worker_idx):
+        print(f"worker {worker_idx} {reason}, requesting a replacement", flush=True)
+
+
+def wait_for_handover(worker_status, worker_idx, stop_event):
+    """
+    Called by a pre-warmed replacement worker after loading the models. Signals the worker it
+    replaces to retire and waits until that worker has finished its jobs.
+    :return: False if stopped before the handover
+    """
+    worker_status.standby_ready(worker_idx)
+    print(f"replacement of worker {worker_idx} ready, waiting for the handover", flush=True)
+    while not worker_status.take_over(worker_idx):
+        if stop_event.wait(HANDOVER_POLL_INTERVAL):
+            return False
+    print(f"replacement of worker {worker_idx} took over", flush=True)
+    return True
+
+
+class WorkerStatus(object):
+    """
+    Per worker bookkeeping kept in shared memory so that the task manager (parent process)
+    can see what each consumer process is doing.
+
+    Recycling a worker goes through the states RECYCLE_REQUESTED (set by the worker reaching its
+    limits, the task manager starts a replacement), RECYCLE_STANDBY_READY (set by the replacement
+    once its models are loaded, the worker stops taking jobs), RECYCLE_HANDED_OVER (set by the
+    worker after finishing its jobs) and back to RECYCLE_NONE when the replacement took over.
+    """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.pids = Array('i', num_workers)
+        self.current_job = Array('i', num_workers)
+        self.job_start = Array('d', num_workers)
+        self.heartbeat = Array('d', num_workers)
+        self.jobs_done = Array('i', num_workers)
+        self.restarts = Array('i', num_workers)
+        self.recycles = Array('i', num_workers)
+        self.recycle = Array('i', num_workers)
+
+    def worker_started(self, idx):
+        self.pids[idx] = os.getpid()
+        self.current_job[idx] = 0
+        self.job_start[idx] = 0
+        self.heartbeat[idx] = time.time()
+
+    def beat(self, idx):
+        self.heartbeat[idx] = time.time()
+
+    def job_started(self, idx, _job_id):
+        self.current_job[idx] = _job_id
+        self.job_start[idx] = time.time()
+        self.heartbeat[idx] = time.time()
+
+    def job_finished(self, idx, _job_id=None):
+        # in pipelined mode a worker has several jobs in flight, keep showing the latest one
+        if _job_id is None or self.current_job[idx] == _job_id:
+            self.current_job[idx] = 0
+            self.job_start[idx] = 0
+        self.jobs_done[idx] += 1
+        self.heartbeat[idx] = time.time()
+
+    def request_recycling(self, idx):
+        """:return: True if the recycling of the worker was not requested already"""
+        with self.recycle.get_lock():
+            if self.recycle[idx] != RECYCLE_NONE:
+                return False
+            self.recycle[idx] = RECYCLE_REQUESTED
+            return True
+
+    def standby_ready(self, idx):
+        with self.recycle.get_lock():
+            if self.recycle[idx] == RECYCLE_REQUESTED:
+                self.recycle[idx] = RECYCLE_STANDBY_READY
+
+    def should_retire(self, idx):
+        return self.recycle[idx] == RECYCLE_STANDBY_READY
+
+    def hand_over(self, idx):
+        with self.recycle.get_lock():
+            self.recycle[idx] = RECYCLE_HANDED_OVER
+
+    def take_over(self, idx):
+        """:return: True if the calling replacement took over the worker slot"""
+        with self.recycle.get_lock():
+            if self.recycle[idx] != RECYCLE_HANDED_OVER:
+                return False
+            self.worker_started(idx)
+            self.recycle[idx] = RECYCLE_NONE
+            return True
+
+    def get_worker_info(self, idx):
+        _job_id = self.current_job[idx]
+        elapsed = time.time() - self.job_start[idx] if _job_id else None
+        return {'worker': idx, 'pid': self.pids[idx], 'current_job_id': _job_id if _job_id else None,
+                'elapsed_secs': elapsed, 'last_heartbeat': self.heartbeat[idx],
+                'jobs_done': self.jobs_done[idx], 'restarts': self.restarts[idx],
+                'recycles': self.recycles[idx]}
 
 
 class TaskManager(object):
-    def __init__(self, model_dir: Path):
-        self.queue = Queue(maxsize=1000)
+    def __init__(self, model_dir: Path, num_workers=1, health_check_interval=5.0, queue_mode='memory',
+                 poll_interval=2.0, stale_claim_timeout=300.0, pipeline_config=None, job_deadline=None,
+                 priority_weights=None, scheduling_policy='fifo', aging_rate=2.0, max_attempts=3, max_retries=0,
+                 recycle_limits=None):
+        """
+        :param job_deadline: max wall time (secs) of a job, None for no deadline
+        :param priority_weights: weighted fair share of the job priority classes
+        :param scheduling_policy: order of the jobs within a priority class, 'fifo' or 'sjf' (by estimated cost)
+        :param aging_rate: pages per minute of waiting by which the estimated cost of a job is lowered
+        :param max_attempts: max number of times a job is started before it is given up
+        :param max_retries: number of times a failed extraction is retried right away by the worker
+        :param recycle_limits: max number of jobs and max resident memory in bytes after which a worker
+                               process is replaced by a pre-warmed fresh one, None for no recycling
+        """
+        self.model_dir = model_dir
+        self.pipeline_config = pipeline_config
+        self.job_deadline = job_deadline
+        self.priority_weights = priority_weights or {}
+        self.scheduling_policy = scheduling_policy
+        self.aging_rate = aging_rate
+        self.max_attempts = max_attempts
+        self.max_retries = max_retries
+        self.recycle_limits = recycle_limits if recycle_limits and any(recycle_limits) else None
+        self.queue_mode = queue_mode
+        # in db mode, extraction workers can run on other hosts (see job_worker.py)
+        self.num_workers = max(0 if queue_mode == 'db' else 1, num_workers)
+        self.health_check_interval = health_check_interval
+        self.poll_interval = poll_interval
+        self.stale_claim_timeout = stale_claim_timeout
+        # in memory mode the jobs wait in the per priority queues of the scheduler. The dispatcher thread
+        # hands them over to the workers through a small queue so that urgent jobs can overtake.
+        self.queue = Queue(maxsize=max(1, self.num_workers)) if queue_mode == 'memory' else None
+        self.scheduler = PriorityJobScheduler(self.priority_weights,
+                                              scheduling_policy) if queue_mode == 'memory' else None
+        self.worker_stop_event = MPEvent()
+        self.worker_status = WorkerStatus(max(1, self.num_workers))
         # self.consumer_proc = Process(target=consumer_test, args=(self.queue,))
-        self.consumer_proc = Process(target=job_consumer, args=(self.queue, model_dir,))
+        self.workers = [self._create_worker(i) for i in range(self.num_workers)]
+        # worker idx -> pre-warmed replacement of a worker being recycled
+        self.standbys = {}
+        self.stop_event = threading.Event()
+        self.monitor_thread = threading.Thread(target=self._monitor_workers, daemon=True)
+        self.dispatcher_thread = threading.Thread(target=self._dispatch_jobs, daemon=True)
+
+    def _create_worker(self, idx, standby=False):
+        if self.queue_mode == 'db':
+            return Process(target=db_job_consumer, args=(self.worker_stop_event, self.model_dir, idx,
+                                                         self.worker_status,
+                                                         self.poll_interval, self.stale_claim_timeout,
+                                                         self.pipeline_config, self.job_deadline,
+                                                         self.priority_weights, self.scheduling_policy,
+                                                         self.max_attempts, self.max_retries,),
+                           kwargs={'recycle_limits': self.recycle_limits, 'standby': standby},
+                           name=f"db_job_consumer_{idx}")
+        return Process(target=job_consumer, args=(self.queue, self.model_dir, idx, self.worker_status,
+                                                  self.pipeline_config, self.job_deadline, self.max_retries,),
+                       kwargs={'recycle_limits': self.recycle_limits, 'standby': standby,
+                               'stop_event': self.worker_stop_event},
+                       name=f"job_consumer_{idx}")
 
     def start(self):
-        self.consumer_proc.start()
+        for worker in self.workers:
+            worker.start()
+        self.monitor_thread.start()
+        if self.scheduler:
+            self.dispatcher_thread.start()
+
+    def recover_jobs(self):
+        """
+        To be called on startup. Returns the running jobs orphaned by a crash or restart (stale heartbeat,
+        or in memory mode claimed by the workers of a previous server on this host) to the queue or
+        gives them up after max_attempts. In memory mode the waiting jobs are re-enqueued in their
+        original order.
+        :return: the number of reclaimed and re-enqueued jobs
+        """
+        _con = None
+        try:
+            _con = connect()
+            host_prefix = socket.gethostname() + ":" if self.queue_mode == 'memory' else None
+            reclaimed = reclaim_stale_jobs(_con, self.stale_claim_timeout, self.max_attempts, host_prefix)
+            if self.queue_mode == 'db':
+                return len(reclaimed), 0
+            jobs = get_waiting_jobs(_con)
+            for job in jobs:
+                self.enqueue(job)
+            return len(reclaimed), len(jobs)
+        finally:
+            if _con:
+                _con.close()
+
+    def _dispatch_jobs(self):
+        while not self.stop_event.is_set():
+            job = self.scheduler.get(timeout=1)
+            if job is None:
+                continue
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(job, timeout=1)
+                    break
+                except Full:
+                    continue
+
+    def _monitor_workers(self):
+        while not self.stop_event.wait(self.health_check_interval):
+            for idx, worker in enumerate(self.workers):
+                standby = self.standbys.get(idx)
+                if standby is not None and not standby.is_alive() \
+                        and self.worker_status.pids[idx] != standby.pid:
+                    print(f"replacement of worker {idx} died with exit code {standby.exitcode}", flush=True)
+                    self.standbys.pop(idx)
+                    standby = None
+                if worker.is_alive():
+                    if standby is None and self.worker_status.recycle[idx] == RECYCLE_REQUESTED:
+                        print(f"starting a replacement for worker {idx} (pid {worker.pid})", flush=True)
+                        self.standbys[idx] = self._create_worker(idx, standby=True)
+                        self.standbys[idx].start()
+                    continue
+                if standby is not None and (self.worker_status.recycle[idx] == RECYCLE_HANDED_OVER
+                                            or self.worker_status.pids[idx] == standby.pid):
+                    print(f"worker {idx} (pid {worker.pid}) recycled, replaced by pid {standby.pid}", flush=True)
+                    self.worker_status.recycles[idx] += 1
+                    self.workers[idx] = self.standbys.pop(idx)
+                    continue
+                print(f"worker {idx} (pid {worker.pid}) died with exit code {worker.exitcode}, respawning...",
+                      flush=True)
+                # in pipelined mode the worker had several jobs in flight
+                fail_orphaned_jobs(get_worker_name(idx, worker.pid), f"worker died with exit code {worker.exitcode}")
+                self.worker_status.current_job[idx] = 0
+                self.worker_status.restarts[idx] += 1
+                if standby is not None:
+                    # the replacement being warmed up takes over right away
+                    self.worker_status.hand_over(idx)
+                    self.workers[idx] = self.standbys.pop(idx)
+                    continue
+                self.worker_status.recycle[idx] = RECYCLE_NONE
+                self.workers[idx] = self._create_worker(idx)
+                self.workers[idx].start()
+
+    def get_workers_info(self):
+        infos = []
+        for idx, worker in enumerate(self.workers):
+            info = self.worker_status.get_worker_info(idx)
+            info['alive'] = worker.is_alive()
+            infos.append(info)
+        return infos
+
+    def get_queue_size(self):
+        """:return: number of jobs in the in-memory queues of this process (None in db mode)"""
+        if self.queue is None:
+            return None
+        try:
+            return self.scheduler.qsize() + self.queue.qsize()
+        except NotImplementedError:
+            # not available on macOS
+            return self.scheduler.qsize()
 
     def shutdown(self):
+        self.stop_event.set()
+        if self.monitor_thread.is_alive():
+            self.monitor_thread.join()
+        if self.dispatcher_thread.is_alive():
+            self.dispatcher_thread.join()
         if self.queue:
-            self.queue.put({'sentinel': True})
-            self.consumer_proc.join()
+            for _ in self.workers:
+                self.queue.put({'sentinel': True})
+        self.worker_stop_event.set()
+        for worker in self.workers + list(self.standbys.values()):
+            worker.join()
 
     def add_job(self, _con, _paper_id, _pdf_file, _work_dir, use_row_info=False):
         _job_id = create_job(_con, _paper_id, _pdf_file)
-        self.queue.put({'job_id': _job_id, 'paper_id': _paper_id,
-                        'pdf_file': _pdf_file,
-                        'work_dir': _work_dir,
-                        'use_row_info': use_row_info})
+        self.enqueue({'job_id': _job_id, 'paper_id': _paper_id,
+                      'pdf_file': _pdf_file,
+                      'work_dir': _work_dir,
+                      'use_row_info': use_row_info})
         return _job_id
 
-    async def add_job_async(self, _pool,  _paper_id, _pdf_file, _work_dir, use_row_info=False):
-        _job_id = await create_job_async(_pool, _paper_id, _pdf_file, use_row_info=use_row_info)
-        self.queue.put({'job_id': _job_id, 'paper_id': _paper_id,
-                        'pdf_file': _pdf_file,
-                        'work_dir': _work_dir,
-                        'use_row_info': use_row_info})
+    async def add_job_async(self, _pool,  _paper_id, _pdf_file, _work_dir, use_row_info=False,
+                            pdf_hash=None, model_version=None, webhook_url=None, priority=DEFAULT_PRIORITY,
+                            page_count=None):
+        cost_key = job_cost_key(page_count, time.time(), self.aging_rate)
+        _job_id = await create_job_async(_pool, _paper_id, _pdf_file, use_row_info=use_row_info,
+                                         _work_dir=_work_dir, _pdf_hash=pdf_hash, _model_version=model_version,
+                                         _webhook_url=webhook_url, _priority=priority, _page_count=page_count,
+                                         _cost_key=cost_key)
+        self.enqueue({'job_id': _job_id, 'paper_id': _paper_id,
+                      'pdf_file': _pdf_file,
+                      'work_dir': _work_dir,
+                      'use_row_info': use_row_info,
+                      'webhook_url': webhook_url,
+                      'priority': priority,
+                      'cost_key': cost_key})
         return _job_id
 
+    async def add_jobs_async(self, _pool, _entries, use_row_info=False, model_version=None, webhook_url=None,
+                             priority=DEFAULT_PRIORITY):
+        """
+        :param _entries: list of dicts with paper_id, pdf_file, work_dir, pdf_hash and page_count keys
+        :return: batch id and the entries with job_id and job_status added
+        """
+        submit_time = time.time()
+        for entry in _entries:
+            entry['cost_key'] = job_cost_key(entry.get('page_count'), submit_time, self.aging_rate)
+        batch_id, entries = await create_jobs_async(_pool, _entries, use_row_info, model_version, webhook_url,
+                                                    priority)
+        for entry in entries:
+            if entry['job_status'] == 'waiting':
+                self.enqueue({'job_id': entry['job_id'], 'paper_id': entry['paper_id'],
+                              'pdf_file': entry['pdf_file'],
+                              'work_dir': entry['work_dir'],
+                              'use_row_info': use_row_info,
+                              'webhook_url': webhook_url,
+                              'priority': priority,
+                              'cost_key': entry['cost_key']})
+        return batch_id, entries
+
+    async def retry_job_async(self, _pool, _job_id):
+        """
+        Puts a failed, timed out or cancelled job back into the queue. The extraction resumes after the
+        stages completed in the earlier attempts.
+        :return: the job dict or None if the job is not in one of these states
+        """
+        job = await retry_job_async(_pool, _job_id)
+        if job:
+            self.enqueue(job)
+        return job
+
+    def enqueue(self, job):
+        if self.queue_mode == 'db':
+            # the waiting job row is the queue entry
+            return
+        self.scheduler.put(job)
+
 
 def connect():
     params = config()
@@ -133,22 +814,205 @@ def create_job(_con, _paper_id, _pdf_file):
     return _job_id
 
 
-async def create_job_async(_pool, _paper_id, _pdf_file, use_row_info: bool):
-    q = """insert into job_detail (paper_id, pdf_file, last_modified, params) values($1, $2, $3, $4) returning 
-           job_detail_id """
+async def create_job_async(_pool, _paper_id, _pdf_file, use_row_info: bool, _work_dir=None,
+                           _pdf_hash=None, _model_version=None, _webhook_url=None, _priority=DEFAULT_PRIORITY,
+                           _page_count=None, _cost_key=None):
+    q = """insert into job_detail (paper_id, pdf_file, last_modified, params, work_dir, pdf_hash, model_version,
+           webhook_url, page_count) values($1, $2, $3, $4, $5, $6, $7, $8, $9) returning job_detail_id """
+    jq = """insert into jobs (job_status, start_time, job_detail_id, priority, cost_key) values($1, $2, $3, $4, $5)
+            returning job_id"""
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            cur_time = datetime.now()
+            params = "use_row_info=True" if use_row_info else None
+            work_dir = str(_work_dir) if _work_dir else None
+            job_detail_id = await conn.fetchval(q, _paper_id, _pdf_file, cur_time, params, work_dir,
+                                                _pdf_hash, _model_version, _webhook_url, _page_count)
+            _job_id = await conn.fetchval(jq, 'waiting', cur_time, job_detail_id, _priority, _cost_key)
+            return _job_id
+
+
+async def create_job_from_cache_async(_pool, _paper_id, _pdf_file, use_row_info: bool, _work_dir, _pdf_hash,
+                                      _model_version):
+    """
+    Creates an already finished job with the cached results of an earlier extraction of the same
+    PDF content with the same models and parameters.
+    :return: the job id or None if there are no cached results
+    """
+    q = """insert into job_detail (paper_id, pdf_file, last_modified, params, work_dir, pdf_hash, model_version,
+           tables_data) select $1, $2, $3, $4, $5, $6, $7, c.tables_data from result_cache c
+           where c.pdf_hash = $6 and c.model_version = $7 and c.use_row_info = $8 returning job_detail_id"""
     jq = """insert into jobs (job_status, start_time, job_detail_id) values($1, $2, $3) returning job_id"""
     async with _pool.acquire() as conn:
         async with conn.transaction():
             cur_time = datetime.now()
             params = "use_row_info=True" if use_row_info else None
-            job_detail_id = await conn.fetchval(q, _paper_id, _pdf_file, cur_time, params)
-            _job_id = await conn.fetchval(jq, 'waiting', cur_time, job_detail_id)
+            work_dir = str(_work_dir) if _work_dir else None
+            job_detail_id = await conn.fetchval(q, _paper_id, _pdf_file, cur_time, params, work_dir,
+                                                _pdf_hash, _model_version, use_row_info)
+            if job_detail_id is None:
+                return None
+            _job_id = await conn.fetchval(jq, 'finished', cur_time, job_detail_id)
             return _job_id
 
 
-def update_job(_con, _job_id, _job_status, _results_json=None, _err_msg=None):
+async def create_jobs_async(_pool, _entries, use_row_info: bool, _model_version=None, _webhook_url=None,
+                            _priority=DEFAULT_PRIORITY):
+    """
+    Creates the jobs of a batch with a single multi row insert. Entries with cached results
+    get an already finished job.
+    """
+    bq = """insert into batches (created, num_jobs) values($1, $2) returning batch_id"""
+    q = """with input as (select * from unnest($1::text[], $2::text[], $3::text[], $4::text[], $12::int[],
+                          $13::float8[]) as t(paper_id, pdf_file, work_dir, pdf_hash, page_count, cost_key)),
+                d as (insert into job_detail (paper_id, pdf_file, last_modified, params, work_dir, pdf_hash,
+                      model_version, tables_data, webhook_url, page_count)
+                      select i.paper_id, i.pdf_file, $5, $6, i.work_dir, i.pdf_hash, $7, c.tables_data, $10,
+                      i.page_count from input i left join result_cache c on c.pdf_hash = i.pdf_hash
+                      and c.model_version = $7 and c.use_row_info = $8
+                      returning job_detail_id, work_dir, tables_data is not null as cached),
+                j as (insert into jobs (job_status, start_time, job_detail_id, batch_id, priority, cost_key)
+                      select case when d.cached then 'finished' else 'waiting' end, $5, d.job_detail_id, $9, $11,
+                      i.cost_key from d, input i where d.work_dir = i.work_dir order by d.job_detail_id
+                      returning job_id, job_status, job_detail_id)
+           select j.job_id, j.job_status, d.work_dir from j, d where j.job_detail_id = d.job_detail_id"""
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            cur_time = datetime.now()
+            params = "use_row_info=True" if use_row_info else None
+            batch_id = await conn.fetchval(bq, cur_time, len(_entries))
+            rows = await conn.fetch(q, [e['paper_id'] for e in _entries], [e['pdf_file'] for e in _entries],
+                                    [str(e['work_dir']) for e in _entries], [e['pdf_hash'] for e in _entries],
+                                    cur_time, params, _model_version, use_row_info, batch_id, _webhook_url,
+                                    _priority, [e.get('page_count') for e in _entries],
+                                    [e.get('cost_key') for e in _entries])
+    # work dirs are unique per paper
+    wd2entry = {str(e['work_dir']): e for e in _entries}
+    entries = []
+    for row in sorted(rows, key=lambda r: r[0]):
+        entry = dict(wd2entry[row[2]])
+        entry['job_id'] = row[0]
+        entry['job_status'] = row[1]
+        entries.append(entry)
+    return batch_id, entries
+
+
+async def get_job_status_async(_pool, _job_id):
+    async with _pool.acquire() as conn:
+        return await conn.fetchval("select job_status from jobs where job_id = $1", _job_id)
+
+
+async def get_job_status_details_async(_pool, _job_id):
+    # everything but the (potentially large) tables_data
+    q = """select a.job_id, a.job_status, b.err_msg, b.last_modified, b.paper_id, b.pdf_file, b.params, b.stage
+           from jobs a, job_detail b where a.job_detail_id = b.job_detail_id and a.job_id = $1"""
+    async with _pool.acquire() as conn:
+        row = await conn.fetchrow(q, _job_id)
+        if row:
+            return {'job_id': row[0], 'job_status': row[1],
+                    'paper_id': row[4], 'pdf_file': row[5],
+                    'params': row[6] if row[6] else "",
+                    'err_msg': row[2], 'stage': row[7], 'last_modified': row[3]}
+        return None
+
+
+async def get_job_statuses_async(_pool, _job_ids):
+    q = """select job_id, job_status from jobs where job_id = any($1::int[])"""
+    async with _pool.acquire() as conn:
+        rows = await conn.fetch(q, _job_ids)
+        return [{'job_id': row[0], 'job_status': row[1]} for row in rows]
+
+
+async def get_batch_status_async(_pool, _batch_id):
+    q = """select a.job_id, a.job_status, b.paper_id, b.pdf_file from jobs a, job_detail b
+           where a.job_detail_id = b.job_detail_id and a.batch_id = $1 order by a.job_id"""
+    async with _pool.acquire() as conn:
+        rows = await conn.fetch(q, _batch_id)
+        return [{'job_id': row[0], 'job_status': row[1], 'paper_id': row[2], 'pdf_file': row[3]}
+                for row in rows]
+
+
+async def get_queue_stats_async(_pool, _window_secs=600):
+    """
+    :param _window_secs: time window over which the throughput is measured
+    :return: dict with the number of jobs per state, the running jobs (from all workers sharing the
+             database) and the number of jobs processed by the workers within the time window
+    """
+    now = datetime.now()
+    async with _pool.acquire() as conn:
+        rows = await conn.fetch("select job_status, count(*) from jobs group by job_status")
+        jobs_per_state = {row[0]: row[1] for row in rows}
+        rows = await conn.fetch("select priority, count(*) from jobs where job_status = 'waiting' group by priority")
+        waiting_per_priority = {row[0]: row[1] for row in rows}
+        rows = await conn.fetch("""select job_id, claimed_by, claim_time, heartbeat from jobs
+                                   where job_status = 'running' order by job_id""")
+        running = [{'job_id': row[0], 'claimed_by': row[1],
+                    'elapsed_secs': (now - row[2]).total_seconds() if row[2] else None,
+                    'last_heartbeat': row[3]} for row in rows]
+        # cached results become finished without being claimed by a worker
+        processed = await conn.fetchval("""select count(*) from jobs a, job_detail b
+                                           where a.job_detail_id = b.job_detail_id and a.claim_time is not null
+                                           and a.job_status = any($1::text[]) and b.last_modified >= $2""",
+                                        list(FINAL_JOB_STATES), now - timedelta(seconds=_window_secs))
+    return {'jobs_per_state': jobs_per_state, 'waiting_per_priority': waiting_per_priority,
+            'running_jobs': running, 'processed_in_window': processed}
+
+
+async def get_admission_stats_async(_pool, _window_secs=600):
+    """
+    :return: number of waiting jobs and the number of jobs processed by the workers within the time window
+    """
+    async with _pool.acquire() as conn:
+        waiting = await conn.fetchval("select count(*) from jobs where job_status = 'waiting'")
+        processed = await conn.fetchval("""select count(*) from jobs a, job_detail b
+                                           where a.job_detail_id = b.job_detail_id and a.claim_time is not null
+                                           and a.job_status = any($1::text[]) and b.last_modified >= $2""",
+                                        list(FINAL_JOB_STATES), datetime.now() - timedelta(seconds=_window_secs))
+    return waiting, processed
+
+
+def cache_job_result(_con, _job_id):
+    q = """insert into result_cache (pdf_hash, use_row_info, model_version, tables_data, created)
+           select d.pdf_hash, coalesce(d.params = 'use_row_info=True', false), d.model_version, d.tables_data, %s
+           from jobs j, job_detail d where j.job_detail_id = d.job_detail_id and j.job_id = %s
+           and d.pdf_hash is not null and d.model_version is not null and d.tables_data is not null
+           on conflict do nothing"""
+    cursor = None
+    try:
+        cursor = _con.cursor()
+        cursor.execute(q, (datetime.now(), _job_id))
+        _con.commit()
+    except (Exception, psycopg.Error) as error:
+        print("Database error", error)
+        _con.rollback()
+    finally:
+        if cursor:
+            cursor.close()
+
+
+async def invalidate_result_cache_async(_pool, _current_model_version=None):
+    """
+    Removes the cached results computed with models other than the current ones or all of them
+    if no current model version is given.
+    :return: number of removed cache entries
+    """
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            if _current_model_version:
+                status = await conn.execute("delete from result_cache where model_version <> $1",
+                                            _current_model_version)
+            else:
+                status = await conn.execute("delete from result_cache")
+            return int(status.split()[-1])
+
+
+def update_job(_con, _job_id, _job_status, _results_json=None, _err_msg=None, _stats=None, _stage=None):
+    """
+    :param _stage: extraction stage the job was in when it was cancelled or timed out
+    """
     q = """update jobs set job_status = %s where job_id = %s returning job_detail_id"""
-    jq = """update job_detail set tables_data = %s, err_msg = %s, last_modified = %s where job_detail_id = %s"""
+    jq = """update job_detail set tables_data = %s::jsonb, err_msg = %s, last_modified = %s,
+            timings = coalesce(%s::jsonb, timings), stage = coalesce(%s, stage) where job_detail_id = %s"""
     cursor = None
     try:
         cursor = _con.cursor()
@@ -159,15 +1023,300 @@ def update_job(_con, _job_id, _job_status, _results_json=None, _err_msg=None):
             json_str = None
             if _results_json is not None:
                 json_str = _results_json
-            cursor.execute(jq, (json_str, _err_msg, cur_time, job_detail_id))
+            stats_str = json.dumps(_stats) if _stats is not None else None
+            cursor.execute(jq, (json_str, _err_msg, cur_time, stats_str, _stage, job_detail_id))
+        notify_job_status(cursor, _job_id, _job_status, _stats)
         _con.commit()
     except (Exception, psycopg.Error) as error:
         print("Database error", error)
+        _con.rollback()
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def mark_job_running(_con, _job_id, _worker_name):
+    q = """update jobs set job_status = 'running', claimed_by = %s, claim_time = %s, heartbeat = %s,
+           attempts = attempts + 1 where job_id = %s and job_status = 'waiting' returning job_id"""
+    cursor = None
+    try:
+        cursor = _con.cursor()
+        cur_time = datetime.now()
+        cursor.execute(q, (_worker_name, cur_time, cur_time, _job_id))
+        row = cursor.fetchone()
+        if row:
+            notify_job_status(cursor, _job_id, 'running')
+        _con.commit()
+        return row is not None
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def get_waiting_priority_classes(_con):
+    """:return: the priority classes with waiting jobs"""
+    q = """select p from unnest(%s::text[]) p
+           where exists (select 1 from jobs where job_status = 'waiting' and priority = p)"""
+    cursor = None
+    try:
+        cursor = _con.cursor()
+        cursor.execute(q, (list(PRIORITY_CLASSES),))
+        classes = {row[0] for row in cursor.fetchall()}
+        _con.commit()
+        return [c for c in PRIORITY_CLASSES if c in classes]
     finally:
         if cursor:
             cursor.close()
 
 
+def claim_job(_con, _worker_name, _priorities=None, _policy='fifo'):
+    """
+    :param _priorities: priority classes to claim from in order of preference, None for any
+    :param _policy: 'fifo' or 'sjf' to claim the job with the lowest estimated cost (cost_key) of a class
+    """
+    if _priorities is None:
+        job = _claim_job(_con, _worker_name, None, _policy)
+    else:
+        job = None
+        for priority in _priorities:
+            job = _claim_job(_con, _worker_name, priority, _policy)
+            if job:
+                break
+    return job
+
+
+def _claim_job(_con, _worker_name, _priority, _policy):
+    priority_cond = "and priority = %s" if _priority else ""
+    # jobs created before the cost was estimated first
+    order_by = "cost_key nulls first, job_id" if _policy == 'sjf' else "job_id"
+    q = """with c as (select job_id from jobs where job_status = 'waiting' {}
+                      order by {} limit 1 for update skip locked),
+                u as (update jobs j set job_status = 'running', claimed_by = %s, claim_time = %s, heartbeat = %s,
+                      attempts = j.attempts + 1 from c where j.job_id = c.job_id
+                      returning j.job_id, j.job_detail_id)
+           select u.job_id, d.paper_id, d.pdf_file, d.work_dir, d.params, d.webhook_url from u, job_detail d
+           where u.job_detail_id = d.job_detail_id""".format(priority_cond, order_by)
+    cursor = None
+    try:
+        cursor = _con.cursor()
+        cur_time = datetime.now()
+        args = (_priority,) if _priority else ()
+        cursor.execute(q, args + (_worker_name, cur_time, cur_time))
+        row = cursor.fetchone()
+        if row:
+            notify_job_status(cursor, row[0], 'running')
+        _con.commit()
+        if row:
+            return to_job_dict(row[0], row[1], row[2], row[3], row[4], row[5])
+        return None
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def get_active_work_dirs(_con):
+    """:return: the work dirs of the waiting and running jobs"""
+    q = """select j.job_id, d.paper_id, d.pdf_file, d.work_dir, d.params from jobs j, job_detail d
+           where j.job_detail_id = d.job_detail_id and j.job_status in ('waiting', 'running')"""
+    cursor = None
+    try:
+        cursor = _con.cursor()
+        cursor.execute(q)
+        work_dirs = [to_job_dict(*row)['work_dir'] for row in cursor.fetchall()]
+        _con.commit()
+        return work_dirs
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def get_waiting_jobs(_con):
+    """:return: the waiting jobs in submission order"""
+    q = """select j.job_id, d.paper_id, d.pdf_file, d.work_dir, d.params, d.webhook_url, j.priority, j.cost_key
+           from jobs j, job_detail d where j.job_detail_id = d.job_detail_id and j.job_status = 'waiting'
+           order by j.job_id"""
+    cursor = None
+    try:
+        cursor = _con.cursor()
+        cursor.execute(q)
+        jobs = []
+        for row in cursor.fetchall():
+            job = to_job_dict(row[0], row[1], row[2], row[3], row[4], row[5])
+            job['priority'] = row[6]
+            job['cost_key'] = row[7]
+            jobs.append(job)
+        _con.commit()
+        return jobs
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def to_job_dict(_job_id, _paper_id, _pdf_file, _work_dir, _params, _webhook_url=None):
+    use_row_info = _params is not None and 'use_row_info=True' in _params
+    if not _work_dir:
+        # jobs created before work_dir was recorded
+        wd = get_server_cache_dir()
+        _work_dir = Path(wd, _paper_id + "_use_row_info") if use_row_info else Path(wd, _paper_id)
+    return {'job_id': _job_id, 'paper_id': _paper_id, 'pdf_file': _pdf_file,
+            'work_dir': Path(_work_dir), 'use_row_info': use_row_info, 'webhook_url': _webhook_url}
+
+
+def notify_job_status(cursor, _job_id, _job_status, _stats=None):
+    # delivered to the listeners when the surrounding transaction commits
+    event = {'job_id': _job_id, 'job_status': _job_status}
+    if _stats is not None:
+        # feeds the /metrics endpoint of the API server(s)
+        event['stats'] = _stats
+    payload = json.dumps(event)
+    cursor.execute("select pg_notify(%s, %s)", (JOB_STATUS_CHANNEL, payload))
+
+
+def touch_job_heartbeat(_con, _job_ids):
+    """
+    :return: ids of the given jobs the user requested to cancel
+    """
+    q = """update jobs set heartbeat = %s where job_id = any(%s) returning job_id, cancel_requested"""
+    cursor = None
+    try:
+        cursor = _con.cursor()
+        cursor.execute(q, (datetime.now(), _job_ids))
+        cancel_requested = [row[0] for row in cursor.fetchall() if row[1]]
+        _con.commit()
+        return cancel_requested
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def reclaim_stale_jobs(_con, _stale_claim_timeout, _max_attempts=3, _claimed_by_prefix=None):
+    """
+    Returns the running jobs of crashed or hung workers to the queue.
+    :param _max_attempts: jobs started that many times already are given up ('error')
+    :param _claimed_by_prefix: also reclaim the running jobs claimed by workers with this name prefix
+    :return: ids of the reclaimed jobs
+    """
+    # jobs the user requested to cancel are not run again
+    q = """update jobs j set job_status = case when cancel_requested then 'cancelled'
+           when attempts >= %s then 'error' else 'waiting' end, claimed_by = null
+           from job_detail d
+           where j.job_detail_id = d.job_detail_id and j.job_status = 'running'
+           and (j.heartbeat is null or j.heartbeat < %s or j.claimed_by like %s)
+           returning j.job_id, j.job_status, j.job_detail_id, d.paper_id, d.webhook_url"""
+    jq = """update job_detail set err_msg = %s, last_modified = %s where job_detail_id = any(%s)"""
+    claimed_by_pattern = escape_like(_claimed_by_prefix) + '%' if _claimed_by_prefix else None
+    cursor = None
+    try:
+        cursor = _con.cursor()
+        cursor.execute(q, (_max_attempts, datetime.now() - timedelta(seconds=_stale_claim_timeout),
+                           claimed_by_pattern))
+        rows = cursor.fetchall()
+        job_ids = [row[0] for row in rows]
+        given_up = [row[2] for row in rows if row[1] == 'error']
+        if given_up:
+            cursor.execute(jq, (f"gave up after {_max_attempts} attempts", datetime.now(), given_up))
+        for _job_id, _job_status, *_ in rows:
+            notify_job_status(cursor, _job_id, _job_status)
+        _con.commit()
+        for _job_id, _job_status, _, _paper_id, _webhook_url in rows:
+            if _job_status == 'error':
+                post_webhook({'job_id': _job_id, 'paper_id': _paper_id, 'webhook_url': _webhook_url}, _job_status,
+                             _err_msg=f"gave up after {_max_attempts} attempts")
+            elif _job_status == 'cancelled':
+                post_webhook({'job_id': _job_id, 'paper_id': _paper_id, 'webhook_url': _webhook_url}, _job_status)
+        if job_ids:
+            print(f"reclaimed stale jobs {job_ids}", flush=True)
+        return job_ids
+    finally:
+        if cursor:
+            cursor.close()
+
+
+async def cancel_job_async(_pool, _job_id):
+    """
+    Cancels a waiting job right away. For a running job, a cancel request is recorded which the
+    heartbeat of the worker running it picks up (the job then ends up as 'cancelled').
+    :return: status of the job after the cancellation or None if there is no such job
+    """
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow("""select j.job_status, j.job_detail_id, d.paper_id, d.webhook_url
+                                         from jobs j join job_detail d on j.job_detail_id = d.job_detail_id
+                                         where j.job_id = $1 for update of j""", _job_id)
+            if not row:
+                return None
+            _job_status = row[0]
+            if _job_status == 'waiting':
+                _job_status = 'cancelled'
+                await conn.execute("update jobs set job_status = $1 where job_id = $2", _job_status, _job_id)
+                await conn.execute("""update job_detail set err_msg = 'job cancelled', last_modified = $1
+                                      where job_detail_id = $2""", datetime.now(), row[1])
+                await conn.execute("select pg_notify($1, $2)", JOB_STATUS_CHANNEL,
+                                   json.dumps({'job_id': _job_id, 'job_status': _job_status}))
+            elif _job_status == 'running':
+                await conn.execute("update jobs set cancel_requested = true where job_id = $1", _job_id)
+    if row[0] == 'waiting':
+        post_webhook({'job_id': _job_id, 'paper_id': row[2], 'webhook_url': row[3]}, _job_status,
+                     _err_msg='job cancelled')
+    return _job_status
+
+
+async def retry_job_async(_pool, _job_id):
+    q = """update jobs set job_status = 'waiting', claimed_by = null, cancel_requested = false, attempts = 0
+           where job_id = $1 and job_status = any($2::text[]) returning job_detail_id, priority, cost_key"""
+    dq = """update job_detail set err_msg = null, last_modified = $1 where job_detail_id = $2
+            returning paper_id, pdf_file, work_dir, params, webhook_url"""
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow(q, _job_id, list(RETRYABLE_JOB_STATES))
+            if not row:
+                return None
+            d = await conn.fetchrow(dq, datetime.now(), row[0])
+            await conn.execute("select pg_notify($1, $2)", JOB_STATUS_CHANNEL,
+                               json.dumps({'job_id': _job_id, 'job_status': 'waiting'}))
+    job = to_job_dict(_job_id, d[0], d[1], d[2], d[3], d[4])
+    job['priority'] = row[1]
+    job['cost_key'] = row[2]
+    return job
+
+
+def fail_orphaned_jobs(_worker_name, _err_msg):
+    """
+    Fails the running jobs claimed by a worker process that died.
+    :return: ids of the failed jobs
+    """
+    q = """update jobs j set job_status = 'error', claimed_by = null from job_detail d
+           where j.job_detail_id = d.job_detail_id and j.job_status = 'running' and j.claimed_by = %s
+           returning j.job_id, j.job_detail_id, d.paper_id, d.webhook_url"""
+    jq = """update job_detail set err_msg = %s, last_modified = %s where job_detail_id = any(%s)"""
+    _con = None
+    cursor = None
+    try:
+        _con = connect()
+        cursor = _con.cursor()
+        cursor.execute(q, (_worker_name,))
+        rows = cursor.fetchall()
+        if rows:
+            cursor.execute(jq, (_err_msg, datetime.now(), [row[1] for row in rows]))
+        for row in rows:
+            notify_job_status(cursor, row[0], 'error')
+        _con.commit()
+        for _job_id, _, _paper_id, _webhook_url in rows:
+            post_webhook({'job_id': _job_id, 'paper_id': _paper_id, 'webhook_url': _webhook_url}, 'error',
+                         _err_msg=_err_msg)
+        if rows:
+            print(f"failed jobs {[row[0] for row in rows]} of worker {_worker_name}", flush=True)
+        return [row[0] for row in rows]
+    except (Exception, psycopg.Error) as error:
+        print("Database error", error)
+        return []
+    finally:
+        if cursor:
+            cursor.close()
+        if _con:
+            _con.close()
+
+
 async def remove_job_async(_pool, _job_id):
     q = "select job_detail_id from jobs where job_id = $1"
     async with _pool.acquire() as conn:
@@ -218,42 +1367,83 @@ def remove_job(_con, _job_id):
             cursor.close()
 
 
-async def list_jobs_async(_pool):
-    q = """select a.job_id, a.job_status, b.paper_id, b.pdf_file, b.params from jobs a, 
-           job_detail b where a.job_detail_id = b.job_detail_id"""
+def escape_like(_value):
+    return _value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+async def list_jobs_async(_pool, after_job_id=None, limit=100, job_status=None, paper_id_prefix=None,
+                          since=None, until=None, use_row_info=None):
+    """
+    Keyset paginated job listing in job_id order. Pass the job_id of the last job of a page as
+    after_job_id to get the next page.
+    :param since: only jobs submitted at or after this time
+    :param until: only jobs submitted before this time
+    :return: (list of job info dicts, job_id to pass as after_job_id for the next page or None if last page)
+    """
+    conds = ["a.job_detail_id = b.job_detail_id"]
+    args = []
+
+    def add_cond(cond, value):
+        args.append(value)
+        conds.append(cond.format(len(args)))
+
+    if after_job_id is not None:
+        add_cond("a.job_id > ${}", after_job_id)
+    if job_status:
+        add_cond("a.job_status = ${}", job_status)
+    if paper_id_prefix:
+        add_cond("b.paper_id like ${}", escape_like(paper_id_prefix) + '%')
+    if since:
+        add_cond("a.start_time >= ${}", since)
+    if until:
+        add_cond("a.start_time < ${}", until)
+    if use_row_info is not None:
+        add_cond("b.params = ${}" if use_row_info else "b.params is distinct from ${}", 'use_row_info=True')
+    args.append(limit + 1)
+    q = """select a.job_id, a.job_status, b.paper_id, b.pdf_file, b.params, a.start_time from jobs a,
+           job_detail b where {} order by a.job_id limit ${}""".format(" and ".join(conds), len(args))
     ji_list = []
     async with _pool.acquire() as conn:
-        async with conn.transaction():
-            async for rec in conn.cursor(q):
-                ji = {'job_id': rec[0], 'job_status': rec[1], 'paper_id': rec[2],
-                      'pdf_file': rec[3], 'params': rec[4]}
-                ji_list.append(ji)
-    return ji_list
+        for rec in await conn.fetch(q, *args):
+            ji = {'job_id': rec[0], 'job_status': rec[1], 'paper_id': rec[2],
+                  'pdf_file': rec[3], 'params': rec[4], 'start_time': rec[5]}
+            ji_list.append(ji)
+    next_after_job_id = None
+    if len(ji_list) > limit:
+        ji_list = ji_list[:limit]
+        next_after_job_id = ji_list[-1]['job_id']
+    return ji_list, next_after_job_id
 
 
-async def get_job_details_async(_pool, _job_id):
-    q = """select a.job_id, a.job_status, b.err_msg, b.tables_data, b.paper_id, b.pdf_file, b.params from jobs a, 
-           job_detail b where a.job_detail_id = b.job_detail_id and a.job_id = $1"""
+async def get_job_details_async(_pool, _job_id, raw=False):
+    """
+    :param raw: if True, the result is returned as the JSON string stored in the database
+                (to be spliced into the response as is) instead of being parsed
+    """
+    q = """select a.job_id, a.job_status, b.err_msg, b.tables_data::text, b.paper_id, b.pdf_file, b.params,
+           b.timings::text, b.stage from jobs a, job_detail b
+           where a.job_detail_id = b.job_detail_id and a.job_id = $1"""
     async with _pool.acquire() as conn:
         async with conn.transaction():
             row = await conn.fetchrow(q, _job_id)
             if row:
-                result_json_data = {}
+                result_json_data = "{}" if raw else {}
                 if row[3]:
-                    result_json_data = json.loads(row[3])
+                    result_json_data = row[3] if raw else json.loads(row[3])
                 params = ""
                 if row[6]:
                     params = row[6]
                 return {'job_id': row[0], 'job_status': row[1],
                         'paper_id': row[4], 'pdf_file': row[5],
                         'params': params,
-                        "err_msg": row[2], "result": result_json_data}
+                        "err_msg": row[2], "stage": row[8], "timings": json.loads(row[7]) if row[7] else None,
+                        "result": result_json_data}
             else:
                 return None
 
 
 def get_job_details(_con, _job_id):
-    q = """select a.job_id, a.job_status, b.err_msg, b.tables_data from jobs a, job_detail b 
+    q = """select a.job_id, a.job_status, b.err_msg, b.tables_data::text from jobs a, job_detail b
            where a.job_detail_id = b.job_detail_id and a.job_id = %s"""
     cursor = None
     try:
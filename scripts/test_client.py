@@ -13,6 +13,8 @@ BASE_URL = "http://localhost:8001"
 HOME = os.path.expanduser("~")
 
 CFG_FILE_NAME = ".key_resource_table_extractor.ini"
+# job states after which a job does not change anymore
+FINAL_JOB_STATES = ('finished', 'error', 'cancelled', 'timeout')
 
 
 def save_config(pdf_root_dir):
@@ -89,10 +91,33 @@ def get_job_results(job_id):
         response.raise_for_status()
 
 
+def wait_job_results(job_id, timeout=30, last_status=None):
+    # long-poll: returns as soon as the job is finished/failed (or its status differs from last_status)
+    url = BASE_URL + "/pdf_table_extractor/wait_job_results"
+    params = {'job_id': job_id, 'timeout': timeout}
+    if last_status:
+        params['last_status'] = last_status
+    response = requests.get(url, params=params, timeout=timeout + 30)
+    if response.status_code == requests.codes.ok:
+        return response.json()
+    else:
+        response.raise_for_status()
+
+
 @cli.command(name='list')
-def list_jobs():
+@click.option('-a', '--after-job-id', type=int, default=None, help="job_id of the last job of the previous page")
+@click.option('-l', '--limit', type=int, default=100)
+@click.option('-s', '--status', default=None)
+@click.option('-p', '--paper-id-prefix', default=None)
+def list_jobs(after_job_id, limit, status, paper_id_prefix):
     url = BASE_URL + "/pdf_table_extractor/list_jobs"
-    params = {"api_key": get_api_key()}
+    params = {"api_key": get_api_key(), "limit": limit}
+    if after_job_id is not None:
+        params['after_job_id'] = after_job_id
+    if status:
+        params['job_status'] = status
+    if paper_id_prefix:
+        params['paper_id_prefix'] = paper_id_prefix
     response = requests.get(url, params=params)
     if response.status_code == requests.codes.ok:
         print(json.dumps(response.json(), indent=2))
@@ -147,7 +172,7 @@ def save_json(_data, _out_json_file):
         print(f"wrote {_out_json_file}.")
 
 
-def handle_paper(pdf_file: Path, _job_id=None, use_row_info=False):
+def handle_paper(pdf_file: Path, _job_id=None, use_row_info=False, max_wait=600):
     prefix = pdf_file.stem
     parent_name = pdf_file.parent.name
     if not _job_id:
@@ -157,8 +182,13 @@ def handle_paper(pdf_file: Path, _job_id=None, use_row_info=False):
     Path('/tmp/extracted_tables').mkdir(parents=True, exist_ok=True)
     out_file = "/tmp/extracted_tables/{}_{}_tables.json".format(parent_name, prefix)
     print(f"job_id:{_job_id} -- {out_file}")
-    time.sleep(30)
-    test_get_job_results(_job_id, out_file)
+    start_time = time.time()
+    while True:
+        result = wait_job_results(_job_id, timeout=60)
+        if result['job_status'] in FINAL_JOB_STATES or time.time() - start_time >= max_wait:
+            break
+    print(json.dumps(result, indent=2))
+    save_json(result, out_file)
 
 
 @cli.command(name="submit")